@@ -21,15 +21,26 @@
  ***************************************************************************/
  """
 from builtins import str
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from functools import cmp_to_key
 import locale
+import os
+import threading
 
-from qgis.core import QgsRaster, QgsMapLayer
+import numpy as np
+
+from qgis.core import QgsMessageLog, QgsRaster, QgsMapLayer, QgsRectangle
+from qgis.PyQt.QtCore import QObject, pyqtSignal
 
 try:
-    from qgis.core import QgsPointXY, QgsProject
+    from qgis.core import Qgis, QgsLineString, QgsPointXY, QgsProject, QgsTask, QgsWkbTypes
+    LINE_GEOMETRY = QgsWkbTypes.LineGeometry
 except:
-    from qgis.core import QgsPoint as QgsPointXY, QgsMapLayerRegistry as QgsProject
+    from qgis.core import QGis as Qgis, QgsPoint as QgsPointXY, QgsMapLayerRegistry as QgsProject
+    LINE_GEOMETRY = Qgis.Line
+    QgsLineString = None # transformPoints falls back to one point at a time
+    QgsTask = object # QGIS2 has no task manager, so SamplingTask needs QGIS3
 
 def frange(start, end, step):
   while start < end:
@@ -37,42 +48,518 @@ def frange(start, end, step):
     start += step
   yield end
 
-# let's only list single band rasters
-def getRasterLayerNames(single_band_only=True):
-    layerMap = QgsProject.instance().mapLayers()
-    layerNames = []
-    for name, layer in list(layerMap.items()):
-        if layer.type() == QgsMapLayer.RasterLayer and layer.providerType() != 'wms':
-            # determine band count without broad try/except
-            band_count = None
-            band_count_method = getattr(layer, 'bandCount', None) # newer QGIS
-            if callable(band_count_method):
-                band_count = band_count_method()
-            else:
-                provider = layer.dataProvider()
-                provider_band_count = getattr(provider, 'bandCount', None) # older QGIS
-                if callable(provider_band_count):
-                    band_count = provider_band_count()
-            if single_band_only and band_count != 1:
-                continue
-            srs = layer.crs().authid()
-            layerNames.append(str(layer.name()+' '+srs))
-    return sorted(layerNames, key=cmp_to_key(locale.strcoll))
+def bandCount(layer):
+    "Returns the number of bands in a raster layer, or None if we can't tell"
+    # determine band count without broad try/except
+    band_count = None
+    band_count_method = getattr(layer, 'bandCount', None) # newer QGIS
+    if callable(band_count_method):
+        band_count = band_count_method()
+    else:
+        provider = layer.dataProvider()
+        provider_band_count = getattr(provider, 'bandCount', None) # older QGIS
+        if callable(provider_band_count):
+            band_count = provider_band_count()
+    return band_count
+
+class LayerIndex(QObject):
+    """
+    Layers in the project by name, kept up to date from the project's
+    layersAdded and layersRemoved signals and each layer's nameChanged and
+    crsChanged, so finding a layer doesn't scan every layer in the project.
+    Subclasses pick which layers to follow with follows.  Emits changed
+    whenever the list of names might have changed.
+    """
+    changed = pyqtSignal()
+
+    def __init__(self, project=None):
+        QObject.__init__(self)
+        self.project = project or QgsProject.instance()
+        self.layers = {} # layer id: layer
+        self.ids = {} # name: ids of the layers with that name, in the order they were added
+        self.renames = {} # layer id: the slot connected to the layer's nameChanged, so it can be disconnected
+        self.add(list(self.project.mapLayers().values()), notify=False)
+        self.project.layersAdded.connect(self.add)
+        self.project.layersRemoved.connect(self.remove)
+
+    def follows(self, layer):
+        "Returns whether the index should keep track of a layer"
+        return True
+
+    def add(self, layers, notify=True):
+        for layer in layers:
+            if not self.follows(layer):
+                continue
+            layerId = layer.id()
+            self.layers[layerId] = layer
+            self.ids.setdefault(layer.name(), []).append(layerId)
+            self.renames[layerId] = lambda layerId=layerId: self.rename(layerId)
+            layer.nameChanged.connect(self.renames[layerId])
+            layer.crsChanged.connect(self.update)
+        if notify:
+            self.update()
+
+    def remove(self, layerIds):
+        for layerId in layerIds:
+            layer = self.layers.pop(layerId, None)
+            if layer is None:
+                continue
+            self.forgetName(layerId)
+            self.unfollow(layerId, layer)
+        self.update()
+
+    def unfollow(self, layerId, layer):
+        "Disconnects from a layer's signals"
+        rename = self.renames.pop(layerId)
+        # separately, so one failing doesn't leave the other connected
+        try:
+            layer.nameChanged.disconnect(rename)
+        except (RuntimeError, TypeError):
+            pass # the layer has already been deleted, which disconnects it anyway
+        try:
+            layer.crsChanged.disconnect(self.update)
+        except (RuntimeError, TypeError):
+            pass
+
+    def rename(self, layerId):
+        self.forgetName(layerId)
+        self.ids.setdefault(self.layers[layerId].name(), []).append(layerId)
+        self.update()
+
+    def forgetName(self, layerId):
+        for name, ids in list(self.ids.items()):
+            if layerId in ids:
+                ids.remove(layerId)
+                if not ids:
+                    del self.ids[name]
+
+    def update(self):
+        self.changed.emit()
+
+    def layer(self, layerName):
+        "Returns the first layer called layerName, or None if it is missing or invalid"
+        ids = self.ids.get(layerName)
+        if not ids:
+            return None
+        layer = self.layers[ids[0]]
+        if layer.isValid():
+            return layer
+        return None
+
+    def unload(self):
+        "Stops following the project and its layers, e.g. when the plugin is unloaded"
+        self.project.layersAdded.disconnect(self.add)
+        self.project.layersRemoved.disconnect(self.remove)
+        for layerId, layer in self.layers.items():
+            self.unfollow(layerId, layer)
+
+class RasterLayerIndex(LayerIndex):
+    """
+    Raster layers in the project by name (see LayerIndex), with their band
+    counts, so the DEM list can be filled without scanning the project.
+    """
+
+    def __init__(self, project=None):
+        self.bands = {} # layer id: band count, worked out once when the layer is added
+        self.sortedNames = {} # single_band_only: sorted names, until something changes
+        LayerIndex.__init__(self, project)
+
+    def follows(self, layer):
+        return layer.type() == QgsMapLayer.RasterLayer
+
+    def add(self, layers, notify=True):
+        for layer in layers:
+            if self.follows(layer):
+                self.bands[layer.id()] = bandCount(layer)
+        LayerIndex.add(self, layers, notify)
+
+    def remove(self, layerIds):
+        for layerId in layerIds:
+            self.bands.pop(layerId, None)
+        LayerIndex.remove(self, layerIds)
+
+    def update(self):
+        self.sortedNames = {}
+        LayerIndex.update(self)
+
+    def names(self, single_band_only=True):
+        "Returns the sorted names of the raster layers, each followed by its CRS"
+        if single_band_only not in self.sortedNames:
+            layerNames = []
+            for layerId, layer in self.layers.items():
+                if layer.providerType() == 'wms':
+                    continue
+                if single_band_only and self.bands[layerId] != 1:
+                    continue
+                srs = layer.crs().authid()
+                layerNames.append(str(layer.name()+' '+srs))
+            self.sortedNames[single_band_only] = sorted(layerNames, key=cmp_to_key(locale.strcoll))
+        return self.sortedNames[single_band_only]
+
+class LineLayerIndex(LayerIndex):
+    """
+    Line layers in the project by name (see LayerIndex), for the centerline list.
+    """
+
+    def __init__(self, project=None):
+        self.sortedLayers = None # until something changes
+        LayerIndex.__init__(self, project)
+
+    def follows(self, layer):
+        return layer.type() == QgsMapLayer.VectorLayer and layer.geometryType() == LINE_GEOMETRY
+
+    def update(self):
+        self.sortedLayers = None
+        LayerIndex.update(self)
+
+    def lineLayers(self):
+        "Returns the line layers, sorted by name"
+        if self.sortedLayers is None:
+            self.sortedLayers = sorted(self.layers.values(), key=cmp_to_key(lambda a, b: locale.strcoll(a.name(), b.name())))
+        return self.sortedLayers
+
+_layerIndex = None
+_lineLayerIndex = None
+
+def layerIndex():
+    "Returns the RasterLayerIndex of the current project, creating it the first time"
+    global _layerIndex
+    if _layerIndex is None:
+        _layerIndex = RasterLayerIndex()
+    return _layerIndex
+
+def lineLayerIndex():
+    "Returns the LineLayerIndex of the current project, creating it the first time"
+    global _lineLayerIndex
+    if _lineLayerIndex is None:
+        _lineLayerIndex = LineLayerIndex()
+    return _lineLayerIndex
+
+def unloadLayerIndex():
+    global _layerIndex, _lineLayerIndex
+    if _layerIndex is not None:
+        _layerIndex.unload()
+        _layerIndex = None
+    if _lineLayerIndex is not None:
+        _lineLayerIndex.unload()
+        _lineLayerIndex = None
+
+# let's only list single band rasters
+def getRasterLayerNames(single_band_only=True):
+    return layerIndex().names(single_band_only)
                 
 def getRasterLayerByName(layerName):
-    layerMap = QgsProject.instance().mapLayers()
-    for name, layer in list(layerMap.items()):
-        if layer.type() == QgsMapLayer.RasterLayer and layer.name() == layerName:
-            if layer.isValid():
-                return layer
-            else:
-                return None
+    return layerIndex().layer(layerName)
                 
+def getLineLayers():
+    "Returns the line layers in the project, sorted by name"
+    return lineLayerIndex().lineLayers()
+
+def centerlineVertices(layer):
+    """
+    Returns an array of the vertices of the selected feature of a line layer,
+    or its first feature if none is selected, taking the longest part of a
+    multipart line.  Returns None if the layer has no lines.
+    """
+    features = layer.selectedFeatures() or layer.getFeatures()
+    for feature in features:
+        geometry = feature.geometry()
+        if geometry is None or geometry.isEmpty():
+            continue
+        if geometry.isMultipart():
+            parts = geometry.asMultiPolyline()
+        else:
+            parts = [geometry.asPolyline()]
+        parts = [np.array([(point.x(), point.y()) for point in part]) for part in parts if len(part) > 1]
+        if parts:
+            return max(parts, key=lambda part: np.hypot(*np.diff(part, axis=0).T).sum())
+    return None
+
 def valRaster(x,y,rLayer):
 
     z = rLayer.dataProvider().identify(QgsPointXY(x,y), QgsRaster.IdentifyFormatValue).results()[1]
     return z
 
+# size in pixels of the blocks sampleRaster reads, so a long diagonal line doesn't read its whole bounding box
+TILE_SIZE = 256
+
+# numpy equivalents of the raster data types we can sample
+BLOCK_DTYPES = {
+    Qgis.Byte: np.uint8,
+    Qgis.UInt16: np.uint16,
+    Qgis.Int16: np.int16,
+    Qgis.UInt32: np.uint32,
+    Qgis.Int32: np.int32,
+    Qgis.Float32: np.float32,
+    Qgis.Float64: np.float64,
+}
+if hasattr(Qgis, 'Int8'): # QGIS 3.30+
+    BLOCK_DTYPES[Qgis.Int8] = np.int8
+
+def blockToArray(block):
+    "Returns a QgsRasterBlock as a 2d float array, with nan for nodata"
+    array = np.frombuffer(bytes(block.data()), dtype=BLOCK_DTYPES[block.dataType()])
+    array = array.reshape(block.height(), block.width()).astype(float)
+    if block.hasNoDataValue():
+        array[array == block.noDataValue()] = np.nan
+    return array
+
+def gridSize(provider, size=None):
+    "Returns the (columns, rows) to read a raster at; size if given, otherwise its native size"
+    if size is None:
+        return provider.xSize(), provider.ySize()
+    return size
+
+def overviewSizes(raster):
+    "Returns the (columns, rows) of each overview (pyramid level) a raster layer has, as far as its provider can tell us"
+    sizes = []
+    try:
+        pyramids = raster.dataProvider().buildPyramidList()
+    except:
+        return sizes
+    for pyramid in pyramids:
+        # QGIS 3.22 replaced the attributes with getters
+        if callable(getattr(pyramid, 'getExists', None)):
+            if pyramid.getExists():
+                sizes.append((pyramid.getXDim(), pyramid.getYDim()))
+        elif pyramid.exists:
+            sizes.append((pyramid.xDim, pyramid.yDim))
+    return sizes
+
+def previewSize(raster, previewRes):
+    """
+    Returns the (columns, rows) of the overview of a raster layer with the
+    resolution closest to previewRes, or if there are no overviews, the size
+    that gives previewRes (the provider resamples it for us)
+    """
+    extent = raster.extent()
+    sizes = overviewSizes(raster)
+    if not sizes:
+        return max(1, int(round(extent.width()/previewRes))), max(1, int(round(extent.height()/previewRes)))
+    sizes.append((raster.width(), raster.height()))
+    return min(sizes, key=lambda size: abs(np.log(extent.width()/size[0]/previewRes)))
+
+def readTile(provider, band, tileCol, tileRow, size=None):
+    """
+    Reads one TILE_SIZE square block of a raster (smaller at the right and bottom edges)
+    as a float array, at its native size or resampled to size
+    """
+    extent = provider.extent()
+    xSize, ySize = gridSize(provider, size)
+    xRes = extent.width()/xSize
+    yRes = extent.height()/ySize
+    col = tileCol*TILE_SIZE
+    row = tileRow*TILE_SIZE
+    cols = min(TILE_SIZE, xSize - col)
+    rows = min(TILE_SIZE, ySize - row)
+    xMin = extent.xMinimum() + col*xRes
+    yMax = extent.yMaximum() - row*yRes
+    block = provider.block(band, QgsRectangle(xMin, yMax - rows*yRes, xMin + cols*xRes, yMax), cols, rows)
+    if not block.isValid():
+        return np.full((rows, cols), np.nan)
+    return blockToArray(block)
+
+class TileCache(object):
+    """
+    Least recently used cache of raster tiles, keyed by layer ID, tile column,
+    tile row, band and the size the raster is read at, so cutting many sections
+    from the same DEM doesn't keep reading the same pixels.  Holds up to maxBytes of tiles, and drops a layer's
+    tiles when its data source or data changes.
+    """
+
+    def __init__(self, maxBytes=64*1024*1024):
+        self.maxBytes = maxBytes
+        self.tiles = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.watched = set()
+        # tiles can be read by sampling tasks in the background
+        self.lock = threading.Lock()
+
+    def tile(self, raster, band, tileCol, tileRow, size=None, provider=None):
+        """
+        Returns a tile of a raster layer as a float array, reading it if it isn't
+        cached, from provider if given (e.g. a clone for use in another thread).
+        This only reads, so it can be called from any thread; the layer's tiles
+        are only dropped when it changes once watch has been called for it.
+        """
+        key = (raster.id(), tileCol, tileRow, band, size)
+        with self.lock:
+            array = self.tiles.get(key)
+            if array is not None:
+                self.hits += 1
+                self.tiles.move_to_end(key)
+                return array
+            self.misses += 1
+        array = readTile(provider or raster.dataProvider(), band, tileCol, tileRow, size)
+        with self.lock:
+            if key not in self.tiles:
+                self.tiles[key] = array
+                self.bytes += array.nbytes
+            while self.bytes > self.maxBytes and len(self.tiles) > 1:
+                key, oldest = self.tiles.popitem(last=False)
+                self.bytes -= oldest.nbytes
+        return array
+
+    def watch(self, raster):
+        """
+        Invalidates a layer's tiles when it changes.  Call it from the thread the
+        layer lives in (the GUI thread), since the connections are made in the
+        calling thread and a worker thread has no event loop to receive them.
+        """
+        layerId = raster.id()
+        with self.lock:
+            if layerId in self.watched:
+                return
+            self.watched.add(layerId)
+        invalidate = lambda *args: self.invalidate(layerId)
+        for signal in ['dataSourceChanged', 'dataChanged', 'willBeDeleted']:
+            # not all of these exist in older versions of QGIS
+            if hasattr(raster, signal):
+                getattr(raster, signal).connect(invalidate)
+
+    def invalidate(self, layerId=None):
+        "Drops the tiles of one layer, or all of them"
+        with self.lock:
+            for key in list(self.tiles):
+                if layerId is None or key[0] == layerId:
+                    self.bytes -= self.tiles.pop(key).nbytes
+
+    def stats(self):
+        "Returns the hit and miss counts and size of the cache for the log"
+        return 'tile cache: {0} hits, {1} misses, {2} tiles ({3:.1f} MB)'.format(self.hits, self.misses, len(self.tiles), self.bytes/1048576.)
+
+TILE_CACHE = TileCache()
+
+def fingerprint(array):
+    "Returns a cheap key for the contents of an array: its shape and type, and a hash of its bytes"
+    array = np.ascontiguousarray(array)
+    return (array.shape, array.dtype.str, hash(array.tobytes()))
+
+class ResultCache(object):
+    """
+    Least recently used cache of solver results, keyed by whatever identifies
+    the problem (e.g. the fingerprint of the section with the water surface
+    elevation, n, slope and units), so solving the same thing again (switching
+    back to a tab or unit, or saving twice) is a lookup.  Holds up to
+    maxEntries results.  The results are shared, so they mustn't be changed.
+    """
+
+    def __init__(self, maxEntries=256):
+        self.maxEntries = maxEntries
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        # results can be solved by tasks in the background
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.results
+
+    def get(self, key, solve):
+        "Returns the result for key, calling solve() for it if it isn't cached"
+        with self.lock:
+            if key in self.results:
+                self.hits += 1
+                self.results.move_to_end(key)
+                return self.results[key]
+            self.misses += 1
+        result = solve()
+        with self.lock:
+            self.results[key] = result
+            while len(self.results) > self.maxEntries:
+                self.results.popitem(last=False)
+        return result
+
+    def invalidate(self):
+        "Drops all the results"
+        with self.lock:
+            self.results.clear()
+
+    def stats(self):
+        "Returns the hit and miss counts and size of the cache for the log"
+        return 'results cache: {0} hits, {1} misses, {2} results'.format(self.hits, self.misses, len(self.results))
+
+def pixelValues(raster, band, rows, cols, size=None, provider=None):
+    """
+    Returns the values of the pixels of a raster layer at arrays of rows and
+    columns, with nan outside the raster or on nodata.  Rather than identifying
+    each pixel, they are read in blocks from TILE_CACHE, one provider call for
+    each TILE_SIZE square tile that has a pixel in it and isn't cached.
+    With size the rows and columns are of the raster resampled to that size.
+    provider is passed to TILE_CACHE.
+    """
+    xSize, ySize = gridSize(provider or raster.dataProvider(), size)
+    rows, cols = np.broadcast_arrays(rows, cols)
+    shape = rows.shape
+    rows = rows.ravel().astype(int)
+    cols = cols.ravel().astype(int)
+    inside = (cols >= 0) & (cols < xSize) & (rows >= 0) & (rows < ySize)
+    cols = cols[inside]
+    rows = rows[inside]
+    values = np.full(len(cols), np.nan)
+    tiles = (rows//TILE_SIZE)*(xSize//TILE_SIZE + 1) + cols//TILE_SIZE
+    for tile in np.unique(tiles):
+        inTile = tiles == tile
+        tileRow = rows[inTile][0]//TILE_SIZE
+        tileCol = cols[inTile][0]//TILE_SIZE
+        array = TILE_CACHE.tile(raster, band, tileCol, tileRow, size, provider)
+        values[inTile] = array[rows[inTile] - tileRow*TILE_SIZE, cols[inTile] - tileCol*TILE_SIZE]
+    z = np.full(len(inside), np.nan)
+    z[inside] = values
+    return z.reshape(shape)
+
+def cubicWeights(t):
+    "Returns Catmull-Rom weights for the pixels at offsets -1, 0, 1 and 2 from a fraction t of the way between pixel centres 0 and 1"
+    t2 = t*t
+    t3 = t2*t
+    return np.stack(((-t3 + 2*t2 - t)/2., (3*t3 - 5*t2 + 2)/2., (-3*t3 + 4*t2 + t)/2., (t3 - t2)/2.), axis=-1)
+
+INTERPOLATIONS = ['nearest', 'bilinear', 'bicubic']
+
+def sampleRaster(xs, ys, raster, band=1, interpolation='nearest', size=None, provider=None):
+    """
+    Returns the raster values at arrays of x and y coordinates (in the layer CRS),
+    with nan outside the raster or on nodata.  interpolation is one of
+    INTERPOLATIONS; bilinear leaves out nodata neighbours and reweights the rest,
+    and bicubic falls back to bilinear next to nodata or the edge of the raster.
+    With size the raster is sampled resampled to that many columns and rows,
+    e.g. from an overview.  provider is passed to TILE_CACHE.
+    """
+    extent = (provider or raster.dataProvider()).extent()
+    xSize, ySize = gridSize(provider or raster.dataProvider(), size)
+    xs = np.asarray(xs, dtype=float)
+    ys = np.asarray(ys, dtype=float)
+    # position in pixels from the top left corner
+    cols = (xs - extent.xMinimum())/(extent.width()/xSize)
+    rows = (extent.yMaximum() - ys)/(extent.height()/ySize)
+    nearest = pixelValues(raster, band, np.floor(rows), np.floor(cols), size, provider)
+    if interpolation == 'nearest':
+        return nearest
+    # the pixel centres are at half pixels, so find the one up and to the left of each point
+    col0 = np.floor(cols - 0.5)
+    row0 = np.floor(rows - 0.5)
+    tx = cols - 0.5 - col0
+    ty = rows - 0.5 - row0
+
+    offsets = np.array([0, 1])
+    values = pixelValues(raster, band, row0[:,np.newaxis,np.newaxis] + offsets[np.newaxis,:,np.newaxis], col0[:,np.newaxis,np.newaxis] + offsets[np.newaxis,np.newaxis,:], size, provider)
+    weights = np.stack((1 - ty, ty), axis=-1)[:,:,np.newaxis]*np.stack((1 - tx, tx), axis=-1)[:,np.newaxis,:]
+    valid = ~np.isnan(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        z = np.sum(np.where(valid, weights*values, 0), axis=(1,2))/np.sum(weights*valid, axis=(1,2))
+    # a point on a nodata pixel is still nodata
+    z[np.isnan(nearest)] = np.nan
+    if interpolation == 'bicubic':
+        offsets = np.array([-1, 0, 1, 2])
+        values = pixelValues(raster, band, row0[:,np.newaxis,np.newaxis] + offsets[np.newaxis,:,np.newaxis], col0[:,np.newaxis,np.newaxis] + offsets[np.newaxis,np.newaxis,:], size, provider)
+        weights = cubicWeights(ty)[:,:,np.newaxis]*cubicWeights(tx)[:,np.newaxis,:]
+        complete = ~np.isnan(values).any(axis=(1,2))
+        z[complete] = np.sum(weights*values, axis=(1,2))[complete]
+    return z
+
 # ajh: note this function is currently unused
 def calcElev(self):
   
@@ -95,26 +582,437 @@ def calcElev(self):
         self.btnOk.setEnabled(False)
     return [startPointZdem, endPointZdem]
 
-def elevationSampler(vectSHP,res,raster):
-    "Returns xyz and station distance list from 2d vector and DEM at specified resolution"
-    x = []
-    y = []
-    z = []
-    dist = []
-    vectLength=vectSHP.length
-    for currentDist  in frange(0,vectLength,res):  
-        #print currentDist
-        # creation of the point on the line
-        point = vectSHP.interpolate(currentDist)
-        xp,yp=point.x, point.y
-        x.append(xp)
-        y.append(yp)
-        #print x, y
-        # extraction of the elevation value from the point
-        zp=valRaster(xp,yp,raster)
-        z.append(zp)
-        dist.append(currentDist)
-        # ajh: we actually only need z, dist
-        xyzdList = [x,y,z,dist]
+def pointsAlongLine(vertices, dist):
+    "Returns arrays of x and y at each distance along a polyline given as an array of vertices"
+    vertices = np.asarray(vertices, dtype=float)[:,:2]
+    segLength = np.hypot(*np.diff(vertices, axis=0).T)
+    cumLength = np.concatenate(([0.0], np.cumsum(segLength)))
+    # the segment each point is on; side='right' skips zero length segments, e.g. from a double click
+    i = np.clip(np.searchsorted(cumLength, dist, side='right') - 1, 0, len(segLength) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(segLength[i] > 0, (dist - cumLength[i])/segLength[i], 0.0)
+    xy = vertices[i] + t[:,np.newaxis]*(vertices[i+1] - vertices[i])
+    return xy[:,0], xy[:,1]
+
+def lineStations(vertices, res):
+    """
+    Returns arrays of x, y and distance for stations every res along a polyline
+    given as an array of vertices, plus one at the end of the line
+    """
+    vertices = np.asarray(vertices, dtype=float)[:,:2]
+    length = np.hypot(*np.diff(vertices, axis=0).T).sum()
+    dist = np.append(np.arange(0, length, res), length)
+    x, y = pointsAlongLine(vertices, dist)
+    return x, y, dist
+
+def pixelCrossings(vertices, raster, size=None):
+    """
+    Returns arrays of x, y and distance for a station wherever a polyline given
+    as an array of vertices crosses from one pixel of a raster to the next, plus
+    one at each end of the line.  This is the same set of points a DDA
+    (Amanatides-Woo) traversal visits, but found for each segment at once from
+    where it crosses the grid lines.  With size the pixels are those of the
+    raster resampled to that many columns and rows.
+    """
+    vertices = np.asarray(vertices, dtype=float)[:,:2]
+    extent = raster.extent()
+    origin = np.array([extent.xMinimum(), extent.yMaximum()])
+    if size is None:
+        res = np.array([raster.rasterUnitsPerPixelX(), raster.rasterUnitsPerPixelY()])
+    else:
+        res = np.array([extent.width()/size[0], extent.height()/size[1]])
+    segLength = np.hypot(*np.diff(vertices, axis=0).T)
+    cumLength = np.concatenate(([0.0], np.cumsum(segLength)))
+    dist = [[0.0, cumLength[-1]]]
+    for i in range(len(segLength)):
+        start = vertices[i]
+        end = vertices[i+1]
+        for axis in (0, 1):
+            if start[axis] == end[axis]:
+                continue
+            # grid lines are at origin + k*res in each direction (y counts down from the top, but the lines are the same)
+            lo, hi = sorted(((start[axis] - origin[axis])/res[axis], (end[axis] - origin[axis])/res[axis]))
+            gridLines = origin[axis] + np.arange(np.ceil(lo), np.floor(hi) + 1)*res[axis]
+            t = (gridLines - start[axis])/(end[axis] - start[axis])
+            dist.append(cumLength[i] + t*segLength[i])
+    dist = np.unique(np.concatenate(dist))
+    x, y = pointsAlongLine(vertices, dist)
+    return x, y, dist
+
+def transformPoints(transform, x, y):
+    """
+    Returns arrays of x and y transformed with a QgsCoordinateTransform, all
+    in one call (as a QgsLineString) rather than a QgsPointXY at a time.
+    """
+    if len(x) == 0:
+        return np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    if QgsLineString is None:
+        points = [transform.transform(QgsPointXY(float(xi), float(yi))) for xi, yi in zip(x, y)]
+        return np.array([p.x() for p in points]), np.array([p.y() for p in points])
+    line = QgsLineString(np.asarray(x, dtype=float).tolist(), np.asarray(y, dtype=float).tolist())
+    line.transform(transform)
+    return np.array(line.xVector()), np.array(line.yVector())
+
+def rescaleDistances(fromVertices, toVertices, dist):
+    """
+    Returns distances along a polyline given as an array of vertices measured
+    along the same polyline with its vertices elsewhere, e.g. in another CRS,
+    at the same fraction of the way along each segment.
+    """
+    lengths = []
+    for vertices in (fromVertices, toVertices):
+        vertices = np.asarray(vertices, dtype=float)[:,:2]
+        lengths.append(np.hypot(*np.diff(vertices, axis=0).T))
+    fromLength, toLength = lengths
+    fromCum = np.concatenate(([0.0], np.cumsum(fromLength)))
+    toCum = np.concatenate(([0.0], np.cumsum(toLength)))
+    i = np.clip(np.searchsorted(fromCum, dist, side='right') - 1, 0, len(fromLength) - 1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(fromLength[i] > 0, (dist - fromCum[i])/fromLength[i], 0.0)
+    return toCum[i] + t*toLength[i]
+
+def drawingResolution(transform, x, y, res):
+    """
+    Returns the length in the drawing CRS of res layer units (e.g. a pixel)
+    at the point x, y in the drawing CRS, for a QgsCoordinateTransform from the
+    drawing CRS to the layer CRS.
+    """
+    if transform is None or not transform.isValid() or transform.isShortCircuited():
+        return res
+    xl, yl = transformPoints(transform, [x], [y])
+    back = transform.transform(QgsPointXY(xl[0] + res, yl[0]), transform.ReverseTransform)
+    return float(np.hypot(back.x() - x, back.y() - y))
+
+# number of stations sampleRaster is given at a time, so a task can report progress and be cancelled between them
+CHUNK_SIZE = 2000
+
+# most of the time in a long section is decompressing tiles, which GDAL does without holding the GIL
+THREADS = min(4, os.cpu_count() or 1)
+
+def tileChunks(xs, ys, raster, count, size=None, provider=None):
+    """
+    Splits stations along a line into up to count contiguous (start, end) ranges
+    of about the same length, cut where the line moves from one tile to the next
+    so each range reads its own tiles
+    """
+    provider = provider or raster.dataProvider()
+    extent = provider.extent()
+    xSize, ySize = gridSize(provider, size)
+    cols = np.floor((np.asarray(xs) - extent.xMinimum())/(extent.width()/xSize))//TILE_SIZE
+    rows = np.floor((extent.yMaximum() - np.asarray(ys))/(extent.height()/ySize))//TILE_SIZE
+    changes = np.flatnonzero((np.diff(cols) != 0) | (np.diff(rows) != 0)) + 1
+    if len(changes) == 0 or count < 2:
+        return [(0, len(xs))]
+    # the tile change nearest each even split
+    even = np.arange(1, count)*len(xs)/float(count)
+    cuts = np.unique(changes[np.abs(changes[np.newaxis,:] - even[:,np.newaxis]).argmin(axis=1)])
+    bounds = np.concatenate(([0], cuts, [len(xs)]))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+def sampleStations(xSample, ySample, raster, interpolation='nearest', size=None, provider=None, task=None, threads=THREADS):
+    """
+    Returns an array of the raster's values at arrays of x and y, sampled
+    CHUNK_SIZE points at a time so a QgsTask can follow the progress and cancel
+    (when None is returned).  Long runs of points are split into tile aligned
+    chunks sampled on up to threads threads, each with its own clone of the provider.
+    """
+    # each range of stations fills its own part of z, so the order doesn't depend on which thread finishes first
+    z = np.empty(len(xSample))
+    done = [0]
+    lock = threading.Lock()
+    def sampleRange(bounds, chunkProvider):
+        for start in range(bounds[0], bounds[1], CHUNK_SIZE):
+            if task is not None and task.isCanceled():
+                return
+            chunk = slice(start, min(start + CHUNK_SIZE, bounds[1]))
+            z[chunk] = sampleRaster(xSample[chunk], ySample[chunk], raster, interpolation=interpolation, size=size, provider=chunkProvider)
+            if task is not None:
+                with lock:
+                    done[0] += chunk.stop - chunk.start
+                    task.setProgress(100.*done[0]/len(xSample))
+    chunks = [(0, len(xSample))]
+    if threads > 1 and len(xSample) > CHUNK_SIZE:
+        chunks = tileChunks(xSample, ySample, raster, min(threads, int(np.ceil(len(xSample)/float(CHUNK_SIZE)))), size, provider)
+    if len(chunks) == 1:
+        sampleRange(chunks[0], provider)
+    else:
+        providers = [(provider or raster.dataProvider()).clone() for chunk in chunks]
+        with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+            # list() so any exception in a thread is raised here
+            list(pool.map(sampleRange, chunks, providers))
+    if task is not None and task.isCanceled():
+        return None
+    return z
+
+def elevationSampler(vectSHP,res,raster,crossings=False,interpolation='nearest',size=None,provider=None,task=None,threads=THREADS,transform=None):
+    """
+    Returns xyz and station distance arrays from 2d vector and DEM at specified resolution,
+    or with crossings=True at every pixel crossing, each with the value of the pixel it enters.
+    With a QgsCoordinateTransform from the CRS the line was drawn in to the raster's CRS,
+    the stations (and x, y and distances) stay in the drawing CRS and are transformed to
+    the raster's CRS together, just to be sampled.  Pixel crossings are found along the line
+    between its vertices transformed to the raster's CRS.
+    interpolation, size (to sample an overview, see previewSize) and provider are passed to sampleRaster.
+    With a QgsTask, reports progress to it and returns None if it is cancelled.
+    Long lines are sampled on up to threads threads (see sampleStations).
+    """
+    # ajh: we actually only need z, dist
+    if transform is not None and (not transform.isValid() or transform.isShortCircuited()):
+        transform = None
+    vertices = np.asarray(vectSHP.coords, dtype=float)[:,:2]
+    if crossings:
+        layerVertices = vertices
+        if transform is not None:
+            layerVertices = np.column_stack(transformPoints(transform, vertices[:,0], vertices[:,1]))
+        layerDist = pixelCrossings(layerVertices, raster, size)[2]
+        # sample half way to the next crossing rather than right on the pixel edge
+        # (and the end of the line has the value of the last pixel)
+        middle = (layerDist[:-1] + layerDist[1:])/2.
+        xSample, ySample = pointsAlongLine(layerVertices, np.append(middle, middle[-1:]))
+        dist = layerDist
+        if transform is not None:
+            dist = rescaleDistances(layerVertices, vertices, layerDist)
+        x, y = pointsAlongLine(vertices, dist)
+    else:
+        x, y, dist = lineStations(vertices, res)
+        xSample, ySample = x, y
+        if transform is not None:
+            xSample, ySample = transformPoints(transform, x, y)
+    # extraction of the elevation values, a block at a time rather than identifying each point
+    z = sampleStations(xSample, ySample, raster, interpolation, size, provider, task, threads)
+    if z is None:
+        return None
+    QgsMessageLog.logMessage(TILE_CACHE.stats(), 'Flow Estimator', 0) # 0 is level=Qgis.Info in QGIS3
+    xyzdList = [x,y,z,dist]
     return xyzdList
 
+def transects(vertices, spacing, halfWidth):
+    """
+    Returns the distance along a centerline given as an array of vertices of a
+    transect every spacing (plus one at the end), and arrays of the left and
+    right ends of each transect (looking along the line), halfWidth either side
+    of the centerline at right angles to the segment it crosses.
+    """
+    vertices = np.asarray(vertices, dtype=float)[:,:2]
+    # a zero length segment (e.g. from a double click) has no direction
+    vertices = vertices[np.append(True, np.hypot(*np.diff(vertices, axis=0).T) > 0)]
+    x, y, dist = lineStations(vertices, spacing)
+    delta = np.diff(vertices, axis=0)
+    segLength = np.hypot(*delta.T)
+    cumLength = np.concatenate(([0.0], np.cumsum(segLength)))
+    i = np.clip(np.searchsorted(cumLength, dist, side='right') - 1, 0, len(segLength) - 1)
+    # unit vector to the left of each segment
+    normal = np.column_stack((-delta[:,1], delta[:,0]))/segLength[:,np.newaxis]
+    centre = np.column_stack((x, y))
+    return dist, centre + halfWidth*normal[i], centre - halfWidth*normal[i]
+
+def transectSampler(vertices, spacing, halfWidth, res, raster, interpolation='nearest', size=None, provider=None, task=None, threads=THREADS, transform=None):
+    """
+    Samples transects across a centerline given as an array of vertices (see
+    transects), each with a station every res from its left end.  The points of
+    every transect are sampled together, in one pass over the raster (see
+    sampleStations).  With a QgsCoordinateTransform from the centerline's CRS to
+    the raster's, only the sample points are transformed, as in elevationSampler.
+    Returns the distance of each transect along the centerline, the station of
+    each point across them, and an array of elevations with a row per transect,
+    or None if the QgsTask is cancelled.
+    """
+    if transform is not None and (not transform.isValid() or transform.isShortCircuited()):
+        transform = None
+    dist, left, right = transects(vertices, spacing, halfWidth)
+    width = 2.*halfWidth
+    stations = np.append(np.arange(0, width, res), width)
+    across = (right - left)/width
+    x = left[:,0,np.newaxis] + stations*across[:,0,np.newaxis]
+    y = left[:,1,np.newaxis] + stations*across[:,1,np.newaxis]
+    xSample, ySample = x.ravel(), y.ravel()
+    if transform is not None:
+        xSample, ySample = transformPoints(transform, xSample, ySample)
+    z = sampleStations(xSample, ySample, raster, interpolation, size, provider, task, threads)
+    if z is None:
+        return None
+    QgsMessageLog.logMessage(TILE_CACHE.stats(), 'Flow Estimator', 0) # 0 is level=Qgis.Info in QGIS3
+    return dist, stations, z.reshape(x.shape)
+
+class SamplingTask(QgsTask):
+    """
+    Runs elevationSampler in the background with a clone of the raster's
+    provider, so QGIS doesn't freeze while a long line or a big raster is read,
+    and a mistake can be cancelled.  Emits sampled with the station/elevation
+    array when it finishes, unless it was cancelled or failed.
+    """
+    sampled = pyqtSignal(object)
+
+    def __init__(self, vectSHP, res, raster, crossings=False, interpolation='nearest', size=None, transform=None):
+        QgsTask.__init__(self, 'Sampling ' + raster.name(), QgsTask.CanCancel)
+        self.vectSHP = vectSHP
+        self.res = res
+        self.raster = raster
+        self.crossings = crossings
+        self.interpolation = interpolation
+        self.size = size
+        self.transform = transform
+        # providers aren't safe to use from another thread, but a clone is ours alone
+        self.provider = raster.dataProvider().clone()
+        # the task is made on the GUI thread, where the layer's signals can reach the cache
+        TILE_CACHE.watch(raster)
+        self.staElev = None
+
+    def run(self):
+        try:
+            xyzdList = elevationSampler(self.vectSHP, self.res, self.raster, self.crossings, self.interpolation, self.size, self.provider, self, transform=self.transform)
+        except Exception as e:
+            QgsMessageLog.logMessage('sampling failed: ' + str(e), 'Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
+            return False
+        if xyzdList is None:
+            return False
+        # ajh: I understand np.column_stack is more efficient
+        self.staElev = np.column_stack((xyzdList[-1], xyzdList[-2]))
+        return True
+
+    def finished(self, result):
+        if result:
+            self.sampled.emit(self.staElev)
+
+
+class TransectTask(SamplingTask):
+    """
+    Runs transectSampler in the background, like SamplingTask.  Emits sampled
+    with the distance of each transect along the centerline, the station of each
+    point across them, and an array of elevations with a row per transect.
+    """
+
+    def __init__(self, centerline, spacing, halfWidth, res, raster, interpolation='nearest', size=None, transform=None):
+        SamplingTask.__init__(self, None, res, raster, interpolation=interpolation, size=size, transform=transform)
+        self.centerline = centerline
+        self.spacing = spacing
+        self.halfWidth = halfWidth
+
+    def run(self):
+        try:
+            # finished emits whatever is left in staElev
+            self.staElev = transectSampler(self.centerline, self.spacing, self.halfWidth, self.res, self.raster, self.interpolation, self.size, self.provider, self, transform=self.transform)
+        except Exception as e:
+            QgsMessageLog.logMessage('sampling failed: ' + str(e), 'Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
+            return False
+        return self.staElev is not None
+
+
+class SolveTask(QgsTask):
+    """
+    Runs a solver (e.g. flowEstimator) in the background, so an irregular section
+    doesn't hold up the dialog and the map canvas.  Emits solved with its
+    generation and the solver's result (None if it failed) when it finishes; the
+    generation is just passed back, so the caller can tell whether the inputs
+    have changed since it started.
+    """
+    solved = pyqtSignal(int, object)
+
+    def __init__(self, generation, solver, *args, **kwargs):
+        QgsTask.__init__(self, 'Solving', QgsTask.CanCancel)
+        self.generation = generation
+        self.solver = solver
+        self.args = args
+        self.kwargs = kwargs
+        self.solution = None
+
+    def run(self):
+        try:
+            self.solution = self.solver(*self.args, **self.kwargs)
+        except Exception as e:
+            QgsMessageLog.logMessage('solving failed: ' + str(e), 'Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
+            return False
+        return self.solution is not None
+
+    def finished(self, result):
+        self.solved.emit(self.generation, self.solution if result else None)
+
+
+# number of stages writeRatingCurve solves and writes at a time, so a task can report progress and be cancelled between them
+CURVE_CHUNK_SIZE = 200
+
+# held while a rating curve export writes to disk; saving again cancels the last export, and once it has waited
+# for this the cancelled export won't write anything else over the new files
+EXPORT_LOCK = threading.Lock()
+
+def writeRatingCurve(fileName, stages, curve, fmt, figures=(), plot=None, plotFileName=None, task=None):
+    """
+    Writes a rating curve to the end of a results file.  stages is a function
+    returning the stages to solve (which can take a while itself, e.g. with
+    adaptiveStages), and curve a function returning an array with a row per
+    stage for an array of them, with the water surface elevation first and the
+    discharge second (e.g. from ratingCurve).  The rows are written with fmt
+    CURVE_CHUNK_SIZE stages at a time, so they are on disk as soon as they are
+    worked out, skipping any the curve couldn't solve.  figures is a list of
+    (matplotlib Figure, file name) to save, and plot a function returning a
+    Figure of the whole curve to save as plotFileName.
+    Returns the rows.  With a QgsTask, reports progress to it and returns None
+    if it is cancelled.
+    """
+    def cancelled():
+        return task is not None and task.isCanceled()
+    for figure, figureFileName in figures:
+        with EXPORT_LOCK:
+            if cancelled():
+                return None
+            figure.savefig(figureFileName)
+    stages = stages()
+    rows = []
+    last = -np.inf
+    with open(fileName, 'a') as outFile:
+        for start in range(0, len(stages), CURVE_CHUNK_SIZE):
+            if cancelled():
+                return None
+            # starting from the last stage of the previous chunk, so the curve still gets a row at any breakpoint in between
+            chunk = curve(stages[max(start - 1, 0):start + CURVE_CHUNK_SIZE])
+            chunk = chunk[(chunk[:,0] > last) & ~np.isnan(chunk[:,1])]
+            with EXPORT_LOCK:
+                if cancelled():
+                    return None
+                if len(chunk):
+                    last = chunk[-1,0]
+                    np.savetxt(outFile, chunk, fmt = fmt, delimiter = '\t')
+                    outFile.flush()
+                    rows.append(chunk)
+            if task is not None:
+                task.setProgress(100.*min(start + CURVE_CHUNK_SIZE, len(stages))/len(stages))
+    rows = np.concatenate(rows) if rows else np.empty((0, len(fmt)))
+    if plot is not None:
+        figure = plot(rows)
+        with EXPORT_LOCK:
+            if cancelled():
+                return None
+            figure.savefig(plotFileName)
+    return rows
+
+
+class RatingCurveTask(QgsTask):
+    """
+    Runs writeRatingCurve in the background, so saving doesn't freeze QGIS.
+    Takes the same arguments, and emits exported with the rows when it
+    finishes, unless it was cancelled or failed.
+    """
+    exported = pyqtSignal(object)
+
+    def __init__(self, fileName, stages, curve, fmt, figures=(), plot=None, plotFileName=None):
+        QgsTask.__init__(self, 'Saving rating curve', QgsTask.CanCancel)
+        self.fileName = fileName
+        self.stages = stages
+        self.curve = curve
+        self.fmt = fmt
+        self.figures = figures
+        self.plot = plot
+        self.plotFileName = plotFileName
+        self.rows = None
+
+    def run(self):
+        try:
+            self.rows = writeRatingCurve(self.fileName, self.stages, self.curve, self.fmt, self.figures, self.plot, self.plotFileName, self)
+        except Exception as e:
+            QgsMessageLog.logMessage('saving the rating curve failed: ' + str(e), 'Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
+            return False
+        return self.rows is not None
+
+    def finished(self, result):
+        if result:
+            self.exported.emit(self.rows)
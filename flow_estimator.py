@@ -29,6 +29,7 @@ from qgis.PyQt.QtGui import QIcon
 from .resources import *
 # Import the code for the dialog
 from .flow_estimator_dialog import FlowEstimatorDialog
+from . import FlowEstimator_utils as utils
 import os.path
 
 
@@ -186,6 +187,8 @@ class FlowEstimator(object):
             self.iface.removeToolBarIcon(action)
         # remove the toolbar
         del self.toolbar
+        # stop following the project's layers
+        utils.unloadLayerIndex()
 
 
     def run(self):
@@ -26,21 +26,23 @@ from __future__ import absolute_import
 from builtins import str
 from builtins import zip
 from builtins import range
+from functools import partial
 import os
+import pickle
 
 from qgis.PyQt import QtGui, uic
 from qgis.PyQt.QtGui import QColor, QKeySequence
-from qgis.PyQt.QtWidgets import QApplication, QDialog, QMessageBox, QFileDialog, QDialogButtonBox, QShortcut
-from qgis.PyQt.QtCore import Qt, QObject
+from qgis.PyQt.QtWidgets import QApplication, QDialog, QMessageBox, QFileDialog, QDialogButtonBox, QShortcut, QProgressBar, QPushButton
+from qgis.PyQt.QtCore import Qt, QObject, QTimer
 from qgis.gui import QgsRubberBand
 try:
     from qgis.utils import metadataParser
 except:
 	from qgis.utils import plugins_metadata_parser as metadataParser # older versions of QGIS
 try:
-    from qgis.core import Qgis, QgsMessageLog, QgsPointXY, QgsWkbTypes
+    from qgis.core import Qgis, QgsApplication, QgsCoordinateTransform, QgsMessageLog, QgsPointXY, QgsProject, QgsWkbTypes
 except:
-    from qgis.core import QGis as Qgis, QgsMessageLog, QgsPoint as QgsPointXY
+    from qgis.core import QGis as Qgis, QgsApplication, QgsCoordinateTransform, QgsMessageLog, QgsPoint as QgsPointXY, QgsMapLayerRegistry as QgsProject
 
 try:
     import mplcursors
@@ -65,10 +67,11 @@ try:
 except ImportError:
     from matplotlib.backends.backend_qt4agg import FigureCanvasQTAgg as FigureCanvas
 from matplotlib.figure import Figure
+from matplotlib.patches import Polygon
 from matplotlib.ticker import ScalarFormatter
 
 from . import FlowEstimator_utils as utils
-from .openChannel import flowEstimator
+from .openChannel import CrossSection, adaptiveStages, flowEstimator, flowEstimatorBatch, normalDepthEstimator, ratingCurve, reachTable, simplifySection
 from .ptmaptool import ProfiletoolMapTool
 
 from shapely.geometry import LineString
@@ -91,6 +94,10 @@ if Qgis.QGIS_VERSION_INT > 29000: # Hide and show works on QGIS3, mostly... alth
 else: # Don't change this - hide works on QGIS2, but not show!
     HIDE_ENABLED='False'
 
+# ms between solves while the inputs are changing, so holding an arrow key or scrolling a spin box
+# solves (and redraws) a few times a second with the latest values, rather than once for every step
+RUN_DELAY = 50
+
 FORM_CLASS, _ = uic.loadUiType(os.path.join(
     os.path.dirname(__file__), 'flow_estimator_dialog_base.ui'))
 
@@ -139,6 +146,11 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
         self.axes = self.figure.add_subplot(111)
         self.figure.subplots_adjust(left=.12, bottom=0.15, right=.75, top=.9, wspace=None, hspace=.2) # It would be nice to change this when plotting slope or rating curve, so there isn't a blank space to the right of the graph.
         self.mplCanvas = FigureCanvas(self.figure)
+        # the cross section plot keeps its artists and a copy of the figure without the water; see plotter
+        self.ground = None
+        self.background = None
+        self.capturing = False
+        self.mplCanvas.mpl_connect('draw_event', self.canvasDrawn)
         
         
         #self.widgetPlotToolbar = NavigationToolbar(self.mplCanvas, self.widgetPlot)
@@ -171,16 +183,31 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
 #        rcParams["font.monospace"] = "Courier New, Liberation Mono"
 #        
         #print self.cbDEM.changeEvent
-        self.depth.valueChanged.connect(self.run)
-        self.botWidth.valueChanged.connect(self.run)
-        self.leftSS.valueChanged.connect(self.run)
-        self.rightSS.valueChanged.connect(self.run)
-        self.n.valueChanged.connect(self.run)
-        self.slope.valueChanged.connect(self.run)
-        self.cbWSE.valueChanged.connect(self.run)
-        self.ft.clicked.connect(self.run)
-        self.m.clicked.connect(self.run)
-        self.cbUDwse.valueChanged.connect(self.run)
+        # changes don't solve straight away; they start runTimer, and everything that changes before it
+        # times out is solved together, with whatever the values are by then
+        self.runTimer = QTimer(self)
+        self.runTimer.setSingleShot(True)
+        self.runTimer.setInterval(RUN_DELAY)
+        self.runTimer.timeout.connect(self.run)
+        # results by section and inputs, emptied whenever self.staElev is replaced
+        self.results = utils.ResultCache()
+        self._staElev = np.array([])
+        self.sectionKey = utils.fingerprint(self._staElev)
+        # solves run in the background, and each gets the next generation so an out of date result can be ignored
+        self.generation = 0 # of the latest solve requested by run
+        self.shownGeneration = 0 # of the solve the plot shows
+        self.request = None
+        self.solveTask = None
+        self.depth.valueChanged.connect(self.scheduleRun)
+        self.botWidth.valueChanged.connect(self.scheduleRun)
+        self.leftSS.valueChanged.connect(self.scheduleRun)
+        self.rightSS.valueChanged.connect(self.scheduleRun)
+        self.n.valueChanged.connect(self.scheduleRun)
+        self.slope.valueChanged.connect(self.scheduleRun)
+        self.cbWSE.valueChanged.connect(self.scheduleRun)
+        self.ft.clicked.connect(self.scheduleRun)
+        self.m.clicked.connect(self.scheduleRun)
+        self.cbUDwse.valueChanged.connect(self.scheduleRun)
         # ajh: this doesn't fix it
         #self.btnRefresh.clicked.connect(self.run)
 
@@ -191,29 +218,63 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
         #self.setMinimumSize(self.size())
         self.btnSampleLine.clicked.connect(self.sampleLine)
         self.btnSampleSlope.clicked.connect(self.sampleSlope)
+        self.btnSolveQ.clicked.connect(self.solveNormalDepth)
+        self.btnSampleReach.clicked.connect(self.sampleReach)
        
         # initialise cross-section station-elevation table
         # must initialise it properly (not as None) to allow testing it when saving)
         self.staElev = np.array([])
+        # the same section prepared for flowEstimator; None until a section is loaded
+        self.section = None
+        self.sampleRes = None # resolution the current section was sampled at, if it came from a DEM
+        self.samplingTask = None
+        self.reachTask = None
+        self.reachGeneration = 0 # bumped each time a reach is sampled, so the solve of an older one is ignored
+        self.exportTask = None
         
 	    # it seems nothing has the keyboard focus initially unless we set it manually
         self.tabWidget.setFocus()
 
+    @property
+    def staElev(self):
+        return self._staElev
+
+    @staElev.setter
+    def staElev(self, staElev):
+        # the cached results are for the old section; the fingerprint is worked out once here rather than every solve
+        self._staElev = staElev
+        self.sectionKey = utils.fingerprint(staElev)
+        self.results.invalidate()
+
     # need this to make sure map tool is disconnected if the dialog is closed while it is in use
     def closeEvent(self, event):
         if hasattr(self, "rubberband") and self.rubberband is not None: #is None if the plugin has been reloaded - but we should just close the dialog when reloading, anyway
             self.rubberband.reset(self.polygon)
         self.deactivate()
+        self.unfollowProject()
+
+    def done(self, result):
+        # closing with the buttons or Esc doesn't go through closeEvent
+        self.unfollowProject()
+        QDialog.done(self, result)
+
+    def unfollowProject(self):
+        # the layer indexes outlive the dialog, so stop them calling it once it is closed
+        for signal, slot in ((utils.layerIndex().changed, self.refreshDEMList),
+                             (utils.lineLayerIndex().changed, self.refreshCenterlineList)):
+            try:
+                signal.disconnect(slot)
+            except (RuntimeError, TypeError):
+                pass # already disconnected
 
     def manageGui(self):
         log('manageGui')
-        self.cbDEM.clear() # don't actually need this at the moment, as we only call manageGui once
-        names = utils.getRasterLayerNames()
+        names = self.refreshDEMList()
+        # keep the lists up to date as layers are added, removed or renamed
+        utils.layerIndex().changed.connect(self.refreshDEMList)
+        self.refreshCenterlineList()
+        utils.lineLayerIndex().changed.connect(self.refreshCenterlineList)
         if names:
-            self.cbDEM.addItems(names)
-            self.btnSampleLine.setEnabled(True)
-            self.btnSampleSlope.setEnabled(True)
-
             # If the currently active layer is present in the combo, select it by default.
             # We use findText with the layer name for an exact match.
             active = self.iface.activeLayer()
@@ -227,6 +288,33 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
                     self.cbDEM.setCurrentIndex(idx)
                     self.cbDEM.blockSignals(False)
         self.run()
+
+    def refreshDEMList(self):
+        # refill cbDEM from the layer index, keeping the selected DEM if it is still there
+        current = self.cbDEM.currentText()
+        names = utils.getRasterLayerNames()
+        self.cbDEM.blockSignals(True)
+        self.cbDEM.clear()
+        self.cbDEM.addItems(names)
+        idx = self.cbDEM.findText(current)
+        if idx >= 0:
+            self.cbDEM.setCurrentIndex(idx)
+        self.cbDEM.blockSignals(False)
+        self.btnSampleLine.setEnabled(bool(names))
+        self.btnSampleSlope.setEnabled(bool(names))
+        self.btnSampleReach.setEnabled(bool(names) and self.cbCenterline.count() > 0)
+        return names
+
+    def refreshCenterlineList(self, *args):
+        # refill cbCenterline with the line layers, keeping the selected one if it is still there
+        current = self.cbCenterline.currentData()
+        self.cbCenterline.clear()
+        for layer in utils.getLineLayers():
+            self.cbCenterline.addItem(layer.name(), layer.id())
+        idx = self.cbCenterline.findData(current)
+        if idx >= 0:
+            self.cbCenterline.setCurrentIndex(idx)
+        self.btnSampleReach.setEnabled(self.cbDEM.count() > 0 and self.cbCenterline.count() > 0)
         
 #    def refreshPlot(self):
 #        self.axes.clear()
@@ -234,34 +322,42 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
     def plotter(self):
 
         R, P, area, topWidth, Q, v, depth, xGround, yGround, yGround0, xWater, yWater, yWater0 = self.args
-        self.axes.clear()
-        formatter = ScalarFormatter(useOffset=False)
-        self.axes.yaxis.set_major_formatter(formatter)
-        ground = self.axes.plot(xGround, yGround, 'k')
-        #self.axes.fill_between(xGround, yGround, yGround0, where=yGround>yGround0, facecolor='0.9', interpolate=True)
-        if Q != 0:
-            water = self.axes.plot(xWater, yWater, 'blue')
-            self.axes.fill_between(xWater, yWater, yWater0, where=yWater>=yWater0, facecolor='blue', interpolate=True, alpha = 0.1)
         if self.calcType == 'DEM': # ajh: only difference between this and UD channel (below) is using self.cbWSE.value vs self.cbUDwse.value
             self.outText = 'INPUT\n\nSlope: {7:.4f}\nRoughness: {8:.3f}\nWSE: {10:.2f} {5}\n\nCALCULATED\n\nTop Width: {2:.2f} {5}\nDepth: {6:,.2f} {5}\nArea: {1:,.2f} {5}$^2$\nWetted P: {9:,.2f} {5}\nR: {0:.2f} {5}\nQ: {3:,.3f} {5}$^3$/s\nVelocity {4:,.1f} {5}/s'.format(R, area, topWidth, Q, v, self.units, depth, self.slope.value(), self.n.value(), P, self.cbWSE.value()) 
         elif self.calcType == 'UD': # ajh: only difference between this and DEM channel (above) is using self.cbWSE.value vs self.cbUDwse.value
             self.outText = 'INPUT\n\nSlope: {7:.4f}\nRoughness: {8:.3f}\nWSE: {10:.2f} {5}\n\nCALCULATED\n\nTop Width: {2:.2f} {5}\nDepth: {6:,.2f} {5}\nArea: {1:,.2f} {5}\nWetted P: {9:,.2f} {5}$^2$\nR: {0:.2f} {5}\nQ: {3:,.3f} {5}$^3$/s\nVelocity {4:,.1f} {5}/s'.format(R, area, topWidth, Q, v, self.units, depth, self.slope.value(), self.n.value(), P, self.cbUDwse.value()) 
         else: # self.calcType == 'trap'
             self.outText = 'INPUT\n\nSlope: {7:.4f}\nRoughness: {8:.3f}\nDepth: {10:.2f} {5}\n\nCALCULATED\n\nTop Width: {2:.2f} {5}\nDepth: {6:,.2f} {5}\nArea: {1:,.2f} {5}$^2$\nWetted P: {9:,.2f} {5}\nR: {0:.2f} {5}\nQ: {3:,.3f} {5}$^3$/s\nVelocity {4:,.1f} {5}/s'.format(R, area, topWidth, Q, v, self.units, depth, self.slope.value(), self.n.value(), P, self.depth.value()) 
+        # the ground only changes when a section is loaded (or the trapezoid is resized), and otherwise
+        # only the water and the results text are drawn again, over a copy of everything else
+        ground = (self.calcType, self.units, xGround, yGround)
+        rescale = self.groundChanged(ground)
+        if rescale:
+            self.drawSection(xGround, yGround)
+            self.ground = ground
+        self.drawWater(Q, xWater, yWater, yWater0, rescale)
+
+    def groundChanged(self, ground):
+        if self.ground is None:
+            return True
+        return self.ground[:2] != ground[:2] or not (np.array_equal(self.ground[2], ground[2]) and np.array_equal(self.ground[3], ground[3]))
+
+    def drawSection(self, xGround, yGround):
+        # everything that stays put while the water surface changes, plus the artists drawWater updates
+        self.axes.clear()
+        formatter = ScalarFormatter(useOffset=False)
+        self.axes.yaxis.set_major_formatter(formatter)
+        ground = self.axes.plot(xGround, yGround, 'k')
+        #self.axes.fill_between(xGround, yGround, yGround0, where=yGround>yGround0, facecolor='0.9', interpolate=True)
+        self.waterLine, = self.axes.plot([], [], 'blue')
+        self.waterFill = Polygon(np.zeros((1, 2)), closed=True, facecolor='blue', edgecolor='none', alpha = 0.1)
+        self.axes.add_patch(self.waterFill)
         self.axes.set_xlabel('Station, '+self.units)
         self.axes.set_ylabel('Elevation, '+self.units)
         self.axes.set_title('Cross Section')
         #self.axes.set_ylim(bottom=0)
         #self.axes.show() 
-        
-        #print self.outText
-# ajh: we currently have no reason to use a separate function for this
-        #self.refreshPlotText()
-
-    
-#    def refreshPlotText(self):
-
-        self.axes.annotate(self.outText, xy=(.76,0.02), xycoords='figure fraction')
+        self.annotation = self.axes.annotate('', xy=(.76,0.02), xycoords='figure fraction')
         
         # enable mouseover coordinate display if mplcursors is available
         # using click coordinate display instead could be desirable, to output it when saving results, but we currently recalculate when saving, which clears it
@@ -273,9 +369,52 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
         
         #at.patch.set_boxstyle("round,pad=0.,rounding_size=0.2")
         #self.axes.add_artist(at)
-        self.mplCanvas.draw()
+        self.background = None
+
+    def drawWater(self, Q, xWater, yWater, yWater0, rescale=False):
+        # the water surface is on top, so the fill stops at the ground wherever the ground is higher (e.g. an island)
+        self.waterLine.set_data(xWater, yWater)
+        self.waterFill.set_xy(np.column_stack((np.concatenate((xWater, xWater[::-1])), np.concatenate((yWater, np.minimum(yWater0, yWater)[::-1])))))
+        self.waterLine.set_visible(Q != 0)
+        self.waterFill.set_visible(Q != 0)
+        self.annotation.set_text(self.outText)
+        water = (self.waterFill, self.waterLine, self.annotation)
+        if rescale:
+            # set_data doesn't make room for the water, so fit the axes to it along with the ground
+            self.axes.relim(visible_only=True)
+            self.axes.autoscale_view()
+        if self.background is None:
+            # draw everything but the water, and keep a copy of it to draw the water over next time
+            visible = [artist.get_visible() for artist in water]
+            for artist in water:
+                artist.set_visible(False)
+            self.capturing = True
+            self.mplCanvas.draw()
+            self.capturing = False
+            self.background = self.mplCanvas.copy_from_bbox(self.figure.bbox)
+            for artist, wasVisible in zip(water, visible):
+                artist.set_visible(wasVisible)
+        else:
+            self.mplCanvas.restore_region(self.background)
+        for artist in water:
+            if artist.get_visible():
+                self.axes.draw_artist(artist)
+        self.mplCanvas.blit(self.figure.bbox)
+
+    def canvasDrawn(self, event):
+        # anything else drawing the whole figure (resizing, showing an error, saving) leaves the copy out of date
+        if not self.capturing:
+            self.background = None
         
-    def run(self):
+    def scheduleRun(self, *args):
+        # a change while the timer is running is picked up when it times out, so it isn't restarted;
+        # that way a steady stream of changes still gets solved every RUN_DELAY ms, not just when it stops
+        if not self.runTimer.isActive():
+            self.runTimer.start()
+
+    def run(self, background=True):
+        # anything waiting to be solved is solved now; in the background unless we need the result straight away
+        self.runTimer.stop()
         if self.ft.isChecked():
             self.units = 'ft'
         else:
@@ -284,43 +423,92 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
         if self.tabWidget.currentIndex() == 0:
             log('calc trap channel')
             self.calcType = 'Trap'
-            self.args = flowEstimator(self.depth.value(), self.n.value(), self.slope.value(), widthBottom = self.botWidth.value(), rightSS = self.rightSS.value(), leftSS = self.leftSS.value(), units = self.units)
-            self.figure.patch.set_facecolor("white")
-            self.plotter()
+            wsElev = self.depth.value()
+            channel = dict(widthBottom = self.botWidth.value(), rightSS = self.rightSS.value(), leftSS = self.leftSS.value(), units = self.units)
+            channelKey = ('Trap', self.botWidth.value(), self.rightSS.value(), self.leftSS.value())
         elif self.tabWidget.currentIndex() == 1: # ajh: only difference between this and UD channel (below) is using self.cbWSE.value vs self.cbUDwse.value
             log('calc DEM channel')
-            try:
-                self.calcType = 'DEM'																										          # ajh: TODO combine with DEM channel below
-#                print self.cbWSE.value(), self.n.value(), self.slope.value(), self.staElev, self.units
-                self.args = flowEstimator(self.cbWSE.value(), self.n.value(), self.slope.value(), staElev = self.staElev, units = self.units)
-                self.figure.patch.set_facecolor("white")
-                self.plotter()
-            except:
-                QgsMessageLog.logMessage('could not solve; is the cross-section very unusual?','Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
-                #doesn't seem to do anything: #self.mplCanvas.setEnabled(False)
-                #this doesn't help #self.plotter()
-                self.figure.patch.set_facecolor("red")
-                #self.axes.clear()
-                self.mplCanvas.draw()
+            self.calcType = 'DEM'
+            wsElev = self.cbWSE.value()
+            channel = dict(staElev = self.section, units = self.units)
+            channelKey = self.sectionKey
         else: # ajh: only difference between this and DEM channel (above) is using self.cbWSE.value vs self.cbUDwse.value
             log('calc UD channel')
+            self.calcType = 'UD'
+            wsElev = self.cbUDwse.value()
+            channel = dict(staElev = self.section, units = self.units)
+            channelKey = self.sectionKey
+        # every request gets the next generation, and a result is only shown if nothing has been requested since
+        self.generation += 1
+        # the same inputs give the same result, so it is only solved if it isn't in the results cache
+        key = (channelKey, wsElev, self.n.value(), self.slope.value(), self.units)
+        self.request = (self.generation, key, partial(flowEstimator, wsElev, self.n.value(), self.slope.value(), **channel))
+        if not background or key in self.results or not hasattr(QgsApplication, 'taskManager'): # QGIS2 has no task manager
             try:
-                self.calcType = 'UD'																										          # ajh: TODO combine with DEM channel above
-                #log(str(self.staElev))
-                #print 'self.cbUDwse.value(), self.n.value(), self.slope.value(), staElev = self.staElev, units = self.units'
-                self.args = flowEstimator(self.cbUDwse.value(), self.n.value(), self.slope.value(), staElev = self.staElev, units = self.units)
-                self.figure.patch.set_facecolor("white")
-                self.plotter()
+                result = self.results.get(key, self.request[2])
             except:
-                QgsMessageLog.logMessage('could not solve; is the cross-section very unusual?','Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
-                #doesn't seem to do anything: #self.mplCanvas.setEnabled(False)
-                #this doesn't help #self.plotter()
-                self.figure.patch.set_facecolor("red")
-                #self.axes.clear()
-                self.mplCanvas.draw()
-                
-            
-   
+                result = None
+            self.solved(self.generation, result)
+        elif self.solveTask is None:
+            self.startSolve()
+        # otherwise the solve in progress starts one for the latest request when it finishes
+
+    def startSolve(self):
+        # the section is never changed once it is loaded (a new one replaces it), so the task can share it
+        generation, key, solve = self.request
+        task = utils.SolveTask(generation, self.results.get, key, solve)
+        task.solved.connect(self.solved)
+        self.solveTask = task
+        QgsApplication.taskManager().addTask(task)
+
+    def solved(self, generation, result):
+        # the result of the solve for a generation, back on the GUI thread; None if it failed
+        if self.solveTask is not None and self.solveTask.generation == generation:
+            self.solveTask = None
+        if generation != self.generation:
+            # the inputs have changed since, so this is out of date; solve the latest instead (unless that has been done already)
+            if self.solveTask is None and self.shownGeneration != self.generation:
+                self.startSolve()
+            return
+        self.shownGeneration = generation
+        log(self.results.stats())
+        try:
+            if result is None:
+                raise ValueError('no solution')
+            self.args = result
+            self.figure.patch.set_facecolor("white")
+            self.plotter()
+        except:
+            QgsMessageLog.logMessage('could not solve; is the cross-section very unusual?','Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
+            #doesn't seem to do anything: #self.mplCanvas.setEnabled(False)
+            #this doesn't help #self.plotter()
+            self.figure.patch.set_facecolor("red")
+            #self.axes.clear()
+            self.mplCanvas.draw()
+
+    def solveNormalDepth(self):
+        # set the depth or WSE to the normal depth for the target discharge, instead of making the user hunt for it
+        Q = self.targetQ.value()
+        if self.tabWidget.currentIndex() == 0:
+            widget = self.depth
+            result = normalDepthEstimator(Q, self.n.value(), self.slope.value(), widthBottom = self.botWidth.value(), rightSS = self.rightSS.value(), leftSS = self.leftSS.value(), units = self.units)
+        else:
+            if self.tabWidget.currentIndex() == 1:
+                widget = self.cbWSE
+            else:
+                widget = self.cbUDwse
+            if self.section is None:
+                QMessageBox.warning(self,'Error',
+                                'Try cutting a section from DEM, or loading a UD section from file.')
+                return
+            result = normalDepthEstimator(Q, self.n.value(), self.slope.value(), staElev = self.section, units = self.units)
+        log('normal depth for Q = {0}: {1}'.format(Q, result))
+        if result is None or np.isnan(result) or not widget.minimum() <= result <= widget.maximum():
+            QMessageBox.warning(self,'Error',
+                                'No normal depth found for a discharge of {0:,.3f}; the channel may be too small, or the flow may jump past it where a dry area floods (see the log)'.format(Q))
+            return
+        widget.setValue(result) # schedules self.run, which calls flowEstimator
+
     def sampleLine(self):
         if HIDE_ENABLED == 'True':
             log('hide at sampleLine')
@@ -491,26 +679,23 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
                 QMessageBox.warning(self,'Error',
                                          'Draw a section with more than one point')
             else:
+                points = list(self.pointstoDraw)
+                preview = self.previewSampling.isChecked()
+                refine = preview and self.refineSampling.isChecked()
+                # sampling runs in the background, and calls these when it is done
+                #ajh it would be good to restart the selection again after an error
                 if self.sampleBtnCode == 'sampleLine':
-                    staElevPrev = self.staElev
-                    staElev, error = self.doRubberbandProfile()
-                    if error:
-                        pass
-                        #ajh it would be good to restart the selection again after an error
-                    else:
-                        self.staElev = np.pad(staElev, ((0,0), (0,1)), mode='constant', constant_values=0) # Could we move all this logic for the third column to openChannel.py?
-                        d = np.diff(staElev, axis=0)
-                        self.staElev[1:,2] = np.cumsum(np.sqrt(np.sum(d*d, axis = 1)))
-                        self.doIrregularProfileFlowEstimator(staElevPrev)
+                    def sectionSampled(staElev, res):
+                        self.doIrregularProfileFlowEstimator(staElev, res)
                         #log('self.staElev' + str(self.staElev))
-                        #log('staElevPrev' + str(staElevPrev))
+                    def previewSampled(staElev, res):
+                        # show the preview while we sample it again at full resolution
+                        self.doIrregularProfileFlowEstimator(staElev, res)
+                        self.doRubberbandProfile(points, sectionSampled)
+                    self.doRubberbandProfile(points, previewSampled if refine else sectionSampled, preview)
                 else:
-                    staElev, error = self.doRubberbandProfile()
-                    if error:
-                        pass
-                        #ajh it would be good to restart the selection again after an error
-                    else:
-                        self.doRubberbandSlopeEstimator(staElev)
+                    # there's nothing to look at while the slope is sampled, so skip the preview if we are going to refine it
+                    self.doRubberbandProfile(points, lambda staElev, res: self.doRubberbandSlopeEstimator(staElev), preview and not refine)
 
             #Reset
             self.lastFreeHandPoints = self.pointstoDraw
@@ -566,7 +751,9 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
 #        self.m.setEnabled(True)
 #        self.cbDEM.setEnabled(True)
     
-    def doRubberbandProfile(self):
+    def doRubberbandProfile(self, points, sampled, preview=False):
+        # starts sampling the line through points from the selected DEM as a task, so QGIS doesn't freeze and the user can cancel it
+        # when it finishes, sampled is called with the station/elevation array and the resolution it was sampled at
         layerString = self.cbDEM.currentText()
         log('sampling ' + layerString)
         layer = utils.getRasterLayerByName(' '.join(layerString.split(' ')[:-1]))
@@ -576,72 +763,172 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
         except:
             QMessageBox.warning(self,'Error',
                                 'Selected DEM layer is missing')
-            return [None, 'error']
-        line = LineString(self.pointstoDraw[:-1]) 
-#        log('xyzdList start')
-#        QApplication.processEvents()
-        # ajh: TODO this line is the slow part, expecially if we accidentally sample an aerial photo or something.
-        # we actually only need a zdlist.
-        # we may be able to optimise it by only returning what we need, creating the x y d values with numpy, and other optimisations
-        # but I suspect in reality it all comes down to the provider speed
-        xyzdList = utils.elevationSampler(line,self.xRes, layer)
-#        log('xyzdList end')
-#        QApplication.processEvents()
-        sta = xyzdList[-1]
-        #log(str(sta))
-        elev = xyzdList[-2]
-        #log(str(elev))
-        # ajh: I understand np.column_stack is more efficient
-        staElev = np.column_stack((sta, elev))
-        # we can just do this if we change the input to just d z
-        #staElev = np.column_stack(dzList)
-        #staElev = np.array(list(zip(sta, elev)))
-        log(str(staElev))
+            return
+        line = LineString(points[:-1]) 
+        # sampling is done in a SamplingTask, which reads the DEM a tile at a time (cached, and on several threads for a long line)
+        # and works out the stations with numpy, so most of the time left is the provider decoding blocks
+        # pixel crossings gives one station per pixel the line passes through, rather than sampling some pixels twice and missing others
+        # the interpolation combo box is in the same order as utils.INTERPOLATIONS
+        size = None
+        if preview:
+            # a rough look from the overview closest to the preview resolution is much quicker on a big mosaic
+            size = utils.previewSize(layer, self.previewRes.value())
+            self.xRes = layer.extent().width()/size[0]
+            log('previewing at {0} ({1} x {2})'.format(self.xRes, size[0], size[1]))
+        # the line is drawn in the canvas CRS, and stays there; only the sample points are transformed to the DEM's CRS
+        transform = self.drawingTransform(layer)
+        res = utils.drawingResolution(transform, points[0][0], points[0][1], self.xRes)
+        if self.samplingTask is not None:
+            # only the latest line matters
+            try:
+                self.samplingTask.cancel()
+            except RuntimeError:
+                pass # already finished, and deleted by the task manager
+        task = utils.SamplingTask(line, res, layer, crossings = self.cbSampling.currentIndex() == 1, interpolation = utils.INTERPOLATIONS[self.cbInterpolation.currentIndex()], size = size, transform = transform)
+        task.sampled.connect(lambda staElev: self.profileSampled(staElev, res, sampled))
+        self.samplingTask = task
+        self.showProgress(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def drawingTransform(self, layer, crs=None):
+        # from crs (by default the canvas CRS) to the layer's, or None if they are the same
+        if crs is None:
+            crs = self.iface.mapCanvas().mapSettings().destinationCrs()
+        if crs == layer.crs():
+            return None
         try:
-            np.isnan(np.sum(staElev[:,1]))
-            return [staElev, None]
-        except:
+            return QgsCoordinateTransform(crs, layer.crs(), QgsProject.instance())
+        except TypeError:
+            return QgsCoordinateTransform(crs, layer.crs()) # QGIS2
+
+    def sampleReach(self):
+        # transects along a centerline, all sampled in one pass over the DEM, and each solved for the normal depth of the target discharge
+        layer = utils.getRasterLayerByName(' '.join(self.cbDEM.currentText().split(' ')[:-1]))
+        centerline = QgsProject.instance().mapLayer(self.cbCenterline.currentData()) if self.cbCenterline.count() else None
+        if layer is None or centerline is None:
+            QMessageBox.warning(self,'Error',
+                                'Select a DEM and a centerline layer')
+            return
+        if self.targetQ.value() <= 0:
+            QMessageBox.warning(self,'Error',
+                                'Set the target discharge to solve the reach for')
+            return
+        vertices = utils.centerlineVertices(centerline)
+        if vertices is None:
+            QMessageBox.warning(self,'Error',
+                                'The centerline layer has no lines')
+            return
+        # the transects are laid out in the centerline's CRS, and only the sample points are transformed to the DEM's CRS
+        transform = self.drawingTransform(layer, centerline.crs())
+        res = utils.drawingResolution(transform, vertices[0][0], vertices[0][1], layer.rasterUnitsPerPixelX())
+        log('sampling transects every {0} along {1}, {2} either side, at {3}'.format(self.transectSpacing.value(), centerline.name(), self.transectHalfWidth.value(), res))
+        if self.reachTask is not None:
+            try:
+                self.reachTask.cancel()
+            except RuntimeError:
+                pass # already finished, and deleted by the task manager
+        self.reachGeneration += 1
+        generation = self.reachGeneration
+        task = utils.TransectTask(vertices, self.transectSpacing.value(), self.transectHalfWidth.value(), res, layer, interpolation = utils.INTERPOLATIONS[self.cbInterpolation.currentIndex()], transform = transform)
+        task.sampled.connect(lambda transects: self.reachSampled(generation, transects, layer.name(), centerline.name()))
+        self.reachTask = task
+        self.showProgress(task)
+        QgsApplication.taskManager().addTask(task)
+
+    def reachSampled(self, generation, transects, layerName, centerlineName):
+        # solving every transect can take a while too, so it is done in the background like run()
+        # the header is made now, so it describes what was solved even if the dialog is changed in the meantime
+        centerDist, stations, elevations = transects
+        tolerance = self.simplifyTolerance.value() if self.simplifySections.isChecked() else None
+        outHeader = '*'*20 + '\nFlow Estimator - A QGIS plugin\nEstimates uniform, steady flow in a channel using Mannings equation\n' + '*'*20
+        outHeader += '\n'*5 + 'Type:\tReach\nUnits:\t{0}\nDEM Layer:\t{1}\nCenterline Layer:\t{2}\nTransect Spacing:\t{3}\nTransect Half Width:\t{4}\nDischarge:\t{5:.03f}\nChannel Slope:\t{6:.06f}\nMannings n:\t{7:.02f}\n\n\n\ncenterline station\twater surface elevation\tflow\tvelocity\tR\tarea\ttop width\tdepth\n'.format(self.units, layerName, centerlineName, self.transectSpacing.value(), self.transectHalfWidth.value(), self.targetQ.value(), self.slope.value(), self.n.value())
+        task = utils.SolveTask(generation, reachTable, centerDist, stations, elevations, self.targetQ.value(), self.n.value(), self.slope.value(), self.units, tolerance)
+        task.solved.connect(lambda generation, results: self.reachSolved(generation, results, outHeader))
+        self.reachTask = task
+        self.showProgress(task, 'Solving reach')
+        QgsApplication.taskManager().addTask(task)
+
+    def reachSolved(self, generation, results, outHeader):
+        # back on the GUI thread; None if solving failed
+        if generation != self.reachGeneration:
+            return # another reach has been sampled since
+        self.reachTask = None
+        if results is None:
+            self.iface.messageBar().pushMessage("Flow Estimator", 'Solving the reach failed', Qgis.Warning, duration=30)
+            return
+        centerDist, wsElev, R, P, area, topWidth, Q, v, depth = results
+        outPath = self.outputPath()
+        fileName = outPath + '/FlowEstimatorReach.txt'
+        with open(fileName,'w') as outFile:
+            outFile.write(outHeader)
+            np.savetxt(outFile, np.column_stack((centerDist, wsElev, Q, v, R, area, topWidth, depth)), fmt = ['%.02f', '%.03f'] + ['%.02f']*6, delimiter = '\t')
+        self.iface.messageBar().pushMessage("Flow Estimator", 'Reach of {0} sections saved to {1}'.format(len(centerDist), fileName),duration=30)
+
+    def showProgress(self, task, message='Sampling DEM'):
+        # progress bar and cancel button in the message bar, until the task finishes
+        widget = self.iface.messageBar().createMessage('Flow Estimator', message)
+        progress = QProgressBar()
+        progress.setMaximum(100)
+        cancel = QPushButton('Cancel')
+        cancel.clicked.connect(task.cancel)
+        widget.layout().addWidget(progress)
+        widget.layout().addWidget(cancel)
+        item = self.iface.messageBar().pushWidget(widget, Qgis.Info)
+        task.progressChanged.connect(lambda value: progress.setValue(int(value)))
+        task.taskCompleted.connect(lambda: self.iface.messageBar().popWidget(item))
+        task.taskTerminated.connect(lambda: self.iface.messageBar().popWidget(item))
+        task.taskTerminated.connect(lambda: log(message + ' cancelled or failed'))
+
+    def profileSampled(self, staElev, res, sampled):
+        log(str(staElev))
+        # points outside the DEM, on nodata, or in a block the provider failed to read are nan
+        if np.isnan(staElev[:,1]).any():
             # ajh: sometimes this is not true; I think it is some kind of error communicating with the provider
             # (I am testing with files on a network drive, over a VPN)
             # or perhaps somehow due to suspending the machine and then waking it up again
             QMessageBox.warning(self,'Error',
-                                'Sampled line not within bounds of DEM (perhaps layer CRS is different from project CRS)')
+                                'Sampled line not within bounds of DEM')
             #log(str(staElev))
             # ajh: don't think we need this
             #self.cleaning()
-            
-            return [staElev, 'error']
-            
+            return
+        sampled(staElev, res)
             
         
-    def doIrregularProfileFlowEstimator(self, staElevPrev):
-        # ajh: should review this code, given changes to openChannel.py (use the median?)
-        thalweig = self.staElev[np.where(self.staElev[:,1] == np.min(self.staElev[:,1]))] 
-        thalweigX = thalweig[:,0][0]
-        minElev = thalweig[:,1][0]+.01
+    def doIrregularProfileFlowEstimator(self, staElev, sampleRes=None):
+        # the cumulative distance, thalweg and banks are all worked out once here, rather than every time we run flowEstimator
+        # if the new section isn't usable we keep the previous one
+        staElev = np.asarray(staElev, dtype=float)
+        tolerance = self.simplifyTolerance.value()
+        # sections with missing elevations are left for CrossSection to reject
+        simplify = self.simplifySections.isChecked() and staElev.ndim == 2 and len(staElev) > 2 and np.isfinite(staElev).all()
+        if simplify:
+            count = len(staElev)
+            staElev = simplifySection(staElev, tolerance)
         try:
-            lbMaxEl = self.staElev[np.where(self.staElev[:,0]>thalweigX)][:,1].max()
-        except:
-            QMessageBox.warning(self,'Error', 'Channel not found')
-            # ajh: don't think we need this
-            #self.deactivate()
-            self.staElev = staElevPrev
+            section = CrossSection(staElev)
+            # build the conveyance table now, so changing the WSE, n or slope is just a lookup; the rating curve export uses the same table
+            # replacing self.section is what invalidates it
+            table = section.conveyanceTable()
+            if simplify:
+                # every removed point is within the tolerance of the simplified ground line, so the flow area
+                # can't be out by more than a strip that wide along the wetted perimeter
+                P = table.geometry(section.crestElev)[2]
+                log('simplified section from {0} to {1} points; flow area error at most {2} x wetted perimeter ({3:.3f} at the crest)'.format(count, len(staElev), tolerance, tolerance*P))
+        except ValueError as e:
+            QMessageBox.warning(self,'Error', str(e))
             return
-        try:
-            rbMaxEl = self.staElev[np.where(self.staElev[:,0]<thalweigX)][:,1].max()
-        except:
-            QMessageBox.warning(self,'Error', 'Channel not found')
-            # ajh: don't think we need this
-            #self.deactivate()
-            self.staElev = staElevPrev
-            return 
-        maxElev = np.array([lbMaxEl,rbMaxEl]).min()-0.001 # ajh: let the user set WSE up to 1mm (if units in m) below the crest; I think if we remove this restriction it can cause a rounding error # can change to e.g. +0.001 for testing
-        WSE = maxElev
-        WSE = (self.staElev[:,1].max() - self.staElev[:,1].min())/2. + self.staElev[:,1].min()
-        self.cbWSE.setValue(WSE)# calls self.run, which calls flowEstimator
+        log('conveyance table: {0} breakpoints for {1} points'.format(len(table.breaks), len(section.staElev)))
+        self.section = section
+        self.staElev = section.staElev
+        self.sampleRes = sampleRes
+        minElev = section.minElev+.01
+        maxElev = section.crestElev-0.001 # ajh: let the user set WSE up to 1mm (if units in m) below the crest; I think if we remove this restriction it can cause a rounding error # can change to e.g. +0.001 for testing
+        WSE = (section.maxElev - section.minElev)/2. + section.minElev
+        self.cbWSE.setValue(WSE)# schedules self.run, which calls flowEstimator
         self.cbWSE.setMinimum(minElev)
         self.cbWSE.setMaximum(maxElev)
-        self.cbUDwse.setValue(WSE)# calls self.run, which calls flowEstimator
+        self.cbUDwse.setValue(WSE)# schedules self.run, which calls flowEstimator
         self.cbUDwse.setMinimum(minElev)
         self.cbUDwse.setMaximum(maxElev)
         # ajh: doing it like this might be beneficial if switch from WSE to UD (or vice versa) and then fail to load a section succcessfully 
@@ -668,6 +955,7 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
         #log(str(slope))
 
         self.axes.clear()
+        self.ground = None # so the cross section is drawn from scratch next time
         
         formatter = ScalarFormatter(useOffset=False)
         self.axes.yaxis.set_major_formatter(formatter)
@@ -707,30 +995,24 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
            filePath, __ = QFileDialog.getOpenFileName(self, 'Select tab or space delimited text file containing station and elevation data')
         self.inputFile.setText(filePath)
         log('filePath: ' + filePath)
-        staElevPrev = self.staElev
         try:
             # ajh: np.loadtxt sends a normal warning for an empty file; we want most messages tagged and sent via QgsMessageLog, but QMessageBox below is sufficient in this case
             # we should be able to do this, but it doesn't seem to work.
             # we could alternatively test for an empty file ourselves
             #with warnings.catch_warnings():
             #    warnings.simplefilter("ignore")
-            self.staElev = np.pad(np.loadtxt(filePath, usecols=(0, 1)), ((0,0), (0,1)), mode='constant', constant_values=0)
-            d = np.diff(self.staElev[:,:2], axis=0)
-            self.staElev[1:,2] = np.cumsum(np.sqrt(np.sum(d*d, axis = 1)))
-            #log(str(self.staElev))
+            staElev = np.loadtxt(filePath, usecols=(0, 1))
+            #log(str(staElev))
             self.calcType = 'UD' 
-            self.doIrregularProfileFlowEstimator(staElevPrev)
+            self.doIrregularProfileFlowEstimator(staElev)
         except:
-            self.staElev = staElevPrev
             if (filePath == ('')): # null string for cancel
                 return
             QMessageBox.warning(self,'Error',
                                 'Please check that the text file is space or tab delimited and does not contain header information')
         
         
-    def accept(self):
-        # recalculate in case save has been hit twice (otherwise instead of saving the cross-section png it saves a second copy of the rating curve).
-        self.run()
+    def outputPath(self):
         outPath = self.outputDir.text()
         home = os.path.expanduser("~")
         if outPath == '':
@@ -739,6 +1021,26 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
         # Note that in Python 3.2+ we can just do: os.makedirs("path/to/directory", exist_ok=True)                    
         if not os.path.exists(outPath):
             os.makedirs(outPath)
+        return outPath
+
+    def accept(self):
+        # recalculate in case save has been hit twice (otherwise instead of saving the cross-section png it saves a second copy of the rating curve).
+        # not in the background, because the cross section has to be drawn before it is saved
+        self.run(background=False)
+        if self.exportTask is not None:
+            # don't let the last save carry on writing to the files we are about to replace, or report
+            # anything when it stops; that was on purpose
+            try:
+                self.exportTask.exported.disconnect(self.exportTaskExported)
+                self.exportTask.taskTerminated.disconnect(self.exportTaskTerminated)
+                self.exportTask.cancel()
+            except (RuntimeError, TypeError):
+                pass # already finished, and deleted by the task manager
+            self.exportTask = None
+            # a write already under way finishes first; after that the cancelled task won't write anything else
+            with utils.EXPORT_LOCK:
+                pass
+        outPath = self.outputPath()
         fileName = outPath + '/FlowEstimatorResults.txt'
         fileName2 = outPath + '/FlowEstimatorXS.txt'
         # ajh I think we've fixed the file/folder locking problem on windows by not doing chdir to outPath
@@ -762,7 +1064,7 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
                 # For a UD section this will still list whatever layer is selected on the DEM tab, and its projection
                 # Ideally we should track whether a DEM or UD section has been successfully loaded most recently, so we can tell the truth
                 # Also, if you cut a section from one DEM, fail to cut a section from another DEM, and then save, the results will refer to the wrong file
-                outHeader += '\n'*5 + 'Type:\tDEM/UD Cross Section\nUnits:\t{0}\nDEM Layer:\t{1}\nProjection (Proj4 format):\t{2}\nChannel Slope:\t{3:.06f}\nMannings n:\t{4:.02f}\n\n\n\nstation\televation\n'.format(self.units,self.cbDEM.currentText(), proj4, self.slope.value(), self.n.value())
+                outHeader += '\n'*5 + 'Type:\tDEM/UD Cross Section\nUnits:\t{0}\nDEM Layer:\t{1}\nProjection (Proj4 format):\t{2}\nSample Resolution:\t{5}\nChannel Slope:\t{3:.06f}\nMannings n:\t{4:.02f}\n\n\n\nstation\televation\n'.format(self.units,self.cbDEM.currentText(), proj4, self.slope.value(), self.n.value(), 'Not sampled from DEM' if self.sampleRes is None else self.sampleRes)
                 outFile.write(outHeader)
                 np.savetxt(outFile, self.staElev[:,:2], fmt = '%.3f', delimiter = '\t')
                 # the first time I ran after adding this it crashed...
@@ -777,41 +1079,84 @@ class FlowEstimatorDialog(QDialog, FORM_CLASS):
                 outFile.write(outHeader)
                 wseMax = self.depth.value()
                 wseMin = 0.001
-            self.mplCanvas.print_figure(outPath + '/FlowEstimatorResultsXSFigure')
+            # a copy of the cross section, so it can be saved off the screen while the dialog carries on
+            figures = [(pickle.loads(pickle.dumps(self.figure)), outPath + '/FlowEstimatorResultsXSFigure')]
             outHeader = '\n\n\n\n\n\n\nwater surface elevation\tflow\tvelocity\tR\tarea\ttop width\tdepth\n'
             outFile.write(outHeader)
-            ###do loop here 
-            step = 0.05 # ajh: 50mm steps allow us to produce a sane graph for reasonably shallow sections
-            wseList = []
-            qList = []
-            #log("wseMax " + str(wseMax))
-            #log("wseMin " + str(wseMin))
-            for wse in utils.frange(wseMin, wseMax, step):
-                if self.calcType == 'DEM' or self.calcType == 'UD':
-                    args = flowEstimator(wse, self.n.value(), self.slope.value(), staElev = self.staElev, units = self.units)
-                else:
-                    args = flowEstimator(wse, self.n.value(), self.slope.value(), widthBottom = self.botWidth.value(), rightSS = self.rightSS.value(), leftSS = self.leftSS.value(), units = self.units)
-                R, P, area, topWidth, Q, v, depth, xGround, yGround, yGround0, xWater, yWater, yWater0 = args
-                data = '{0:.03f}\t{1:.02f}\t{2:.02f}\t{3:.02f}\t{4:.02f}\t{5:.02f}\t{6:.02f}\n'.format(wse, Q, v, R, area, topWidth, depth)
-                outFile.write(data)
-                wseList.append(wse)
-                qList.append(Q)
-            
-            self.axes.clear()
-            formatter = ScalarFormatter(useOffset=False)
-            self.axes.yaxis.set_major_formatter(formatter)
-            self.axes.plot(qList, wseList, 'k',label = 'Rating Curve')
-            self.axes.set_ylabel('Water Surface Elevation, '+self.units)
-            self.axes.set_xlabel('Discharge, {0}$^3$/s'.format(self.units))
-            self.axes.set_title('Rating Curve')
-            self.axes.grid()
-            self.mplCanvas.draw()
-            self.mplCanvas.print_figure(outPath + '/FlowEstimatorRatingCurve')          
+            if self.calcType == 'DEM' or self.calcType == 'UD':
+                channel = dict(staElev = self.section, units = self.units)
+                channelKey = self.sectionKey
+            else:
+                channel = dict(widthBottom = self.botWidth.value(), rightSS = self.rightSS.value(), leftSS = self.leftSS.value(), units = self.units)
+                channelKey = ('Trap', self.botWidth.value(), self.rightSS.value(), self.leftSS.value())
         
         # Using a with statement takes care of closing the file automatically
         #outFile.close()
         # ajh this may help force the file lock to be released
         #outFile = None
-        
+
+        # the rating curve is worked out and written in the background, so everything it needs is read from the dialog now
+        n = self.n.value()
+        slope = self.slope.value()
+        units = self.units
+        #log("wseMax " + str(wseMax))
+        #log("wseMin " + str(wseMin))
+        if self.adaptiveSteps.isChecked():
+            tolerance = self.stepTolerance.value()/100.
+            minStep = self.minStep.value()
+            maxStep = self.maxStep.value()
+            def stages():
+                # only subdivide where a straight line between stages would misrepresent the flow
+                discharge = lambda stages: flowEstimatorBatch(stages, n, slope, **channel)[4]
+                key = (channelKey, 'stages', wseMin, wseMax, tolerance, minStep, maxStep, n, slope, units)
+                stages = self.results.get(key, lambda: adaptiveStages(discharge, wseMin, wseMax, tolerance, minStep, maxStep)[0])
+                log("Adaptive rating curve: {0} stages".format(len(stages)))
+                return stages
+        else:
+            step = 0.05 # ajh: 50mm steps allow us to produce a sane graph for reasonably shallow sections
+            stages = lambda: np.fromiter(utils.frange(wseMin, wseMax, step), dtype=float)
+        def solveCurve(stages):
+            # ratingCurve adds a row wherever the section changes shape between the steps, so the curve is exact at the kinks
+            wseList, R, P, area, topWidth, Q, v, depth = ratingCurve(n, slope, stages, **channel)
+            return np.column_stack((wseList, Q, v, R, area, topWidth, depth))
+        # saving again goes through the same chunks of stages, so they are all in the results cache
+        curve = lambda stages: self.results.get((channelKey, 'curve', utils.fingerprint(stages), n, slope, units), lambda: solveCurve(stages))
+        curveFigure = Figure(figsize = self.figure.get_size_inches(), dpi = self.figure.dpi, subplotpars = self.figure.subplotpars)
+        curveFigure.add_subplot(111)
+        fmt = ['%.03f'] + ['%.02f']*6
+        plot = lambda rows: self.plotRatingCurve(curveFigure.axes[0], rows, units)
+        plotFileName = outPath + '/FlowEstimatorRatingCurve'
+        if not hasattr(QgsApplication, 'taskManager'): # QGIS2 has no task manager, so save it here
+            rows = utils.writeRatingCurve(fileName, stages, curve, fmt, figures, plot, plotFileName)
+            self.ratingCurveExported(rows, units, outPath)
+            return
+        task = utils.RatingCurveTask(fileName, stages, curve, fmt, figures, plot, plotFileName)
+        # kept so they can be disconnected if this export is replaced
+        self.exportTaskExported = lambda rows: self.ratingCurveExported(rows, units, outPath)
+        self.exportTaskTerminated = lambda: self.iface.messageBar().pushMessage("Flow Estimator", 'Saving the rating curve was cancelled or failed, so {} is incomplete'.format(fileName), Qgis.Warning, duration=30)
+        task.exported.connect(self.exportTaskExported)
+        task.taskTerminated.connect(self.exportTaskTerminated)
+        self.exportTask = task
+        self.showProgress(task, 'Saving rating curve')
+        QgsApplication.taskManager().addTask(task)
+
+    def plotRatingCurve(self, axes, rows, units):
+        # on the dialog, or on a figure off the screen (from the export task)
+        formatter = ScalarFormatter(useOffset=False)
+        axes.yaxis.set_major_formatter(formatter)
+        axes.plot(rows[:,1], rows[:,0], 'k',label = 'Rating Curve')
+        axes.set_ylabel('Water Surface Elevation, '+units)
+        axes.set_xlabel('Discharge, {0}$^3$/s'.format(units))
+        axes.set_title('Rating Curve')
+        axes.grid()
+        return axes.figure
+
+    def ratingCurveExported(self, rows, units, outPath):
+        # show the rating curve that was saved
+        self.axes.clear()
+        self.ground = None # so the cross section is drawn from scratch next time
+        self.plotRatingCurve(self.axes, rows, units)
+        self.mplCanvas.draw()
+        log(self.results.stats())
         self.iface.messageBar().pushMessage("Flow Estimator", 'Output files saved to {}'.format(outPath),duration=30)
 
@@ -23,12 +23,70 @@ def channelBuilder(wsDepth, rightSS, leftSS, widthBottom):
     leftToe = wsDepth*1.25*leftSS
     rightToe = wsDepth*1.25*rightSS  
     staElev = np.array([(0.0, wsDepth*1.25), (leftToe, 0.0), (leftToe+widthBottom, 0.0), (leftToe+widthBottom+rightToe, wsDepth*1.25)])
-    staElev = np.pad(staElev, ((0,0), (0,1)), mode='constant', constant_values=0)
+    return addDistance(staElev)
+
+
+def addDistance(staElev):
+    """
+    Returns a station/elevation/distance array, where distance is measured
+    along the ground from the first point, given a station/elevation array
+    """
+    staElev = np.pad(np.asarray(staElev, dtype=float)[:,:2], ((0,0), (0,1)), mode='constant', constant_values=0)
     d = np.diff(staElev[:,:2], axis=0)
     staElev[1:,2] = np.cumsum(np.sqrt(np.sum(d*d, axis = 1)))
     return staElev
 
 
+def simplifySection(staElev, tolerance=0.0):
+    """
+    Removes points from a station/elevation array that make no difference to
+    the shape of the section, e.g. duplicates and runs of equal elevations when
+    a DEM is sampled at a finer spacing than its pixels.  With a tolerance of 0
+    only exactly collinear points are removed; otherwise this is Douglas-Peucker,
+    removing points no further than tolerance from the simplified section.
+    The ends and the thalweg are always kept.
+    """
+    staElev = np.asarray(staElev, dtype=float)[:,:2]
+    x = staElev[:,0]
+    y = staElev[:,1]
+    last = len(staElev) - 1
+    thalweg = int(np.argmin(y))
+    keep = np.zeros(len(staElev), dtype=bool)
+    keep[[0, thalweg, last]] = True
+    stack = [(0, thalweg), (thalweg, last)]
+    while stack:
+        i, j = stack.pop()
+        if j - i < 2:
+            continue
+        dx = x[j] - x[i]
+        dy = y[j] - y[i]
+        px = x[i+1:j] - x[i]
+        py = y[i+1:j] - y[i]
+        lengthSq = dx*dx + dy*dy
+        # distance to the chord, or to its nearest end for points that aren't alongside it,
+        # so a section that doubles back on itself isn't simplified away
+        t = (px*dx + py*dy)/lengthSq if lengthSq > 0 else np.zeros(len(px))
+        t = np.clip(t, 0.0, 1.0)
+        offset = np.hypot(px - t*dx, py - t*dy)
+        k = int(np.argmax(offset))
+        if offset[k] > tolerance:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return staElev[keep]
+
+
+def manningConstant(units):
+    """
+    Returns the unit conversion constant for the Manning equation
+    """
+    if units == "m":
+        return 1.0
+    else:
+        return 1.4859
+
+
 def lineIntersection(line1, line2): # ajh: do we need this or can we use a numpy intersect function?
     #log('line1' + str(line1))
     #log('line2' + str(line2))
@@ -56,6 +114,36 @@ def lineIntersection(line1, line2): # ajh: do we need this or can we use a numpy
     #log('d' + str(d))
     return x, y
 
+def waterlineIntersections(staElev, wsElev):
+    """
+    Returns an array of (station, elevation, distance) rows for every point where
+    the water surface crosses a segment of the station/elevation/distance array,
+    in profile order.  This does the same determinant arithmetic as calling
+    lineIntersection on each segment, but for all segments at once.
+    """
+    x0 = staElev[:-1,0]
+    y0 = staElev[:-1,1]
+    x1 = staElev[1:,0]
+    y1 = staElev[1:,1]
+    # line2 is the water surface drawn across the full width of the section
+    xdiff = (x0 - x1, staElev[0][0] - staElev[-1][0])
+    ydiff = (y0 - y1, wsElev - wsElev)
+    div = xdiff[0] * ydiff[1] - xdiff[1] * ydiff[0]
+    d = (x0 * y1 - y0 * x1, staElev[0][0] * wsElev - wsElev * staElev[-1][0])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # div == 0 for horizontal segments, which lineIntersection treats as not intersecting
+        x = np.where(div == 0, np.nan, (d[0] * xdiff[1] - d[1] * xdiff[0]) / div)
+        y = np.where(div == 0, np.nan, (d[0] * ydiff[1] - d[1] * ydiff[0]) / div)
+        dist = staElev[:-1,2] + ( (y-y0)**2 + (x-x0)**2 )**0.5
+        # the 0.001 tolerance catches float error when the water surface passes through a vertex
+        # (CrossSection.waterline doesn't need one, so the two can disagree just above a vertex; see flowEstimator)
+        hit = ((x0 <= x) & (x <= x1)) | ((x0 >= x) & (x >= x1)) | (abs(x - x1) < 0.001) | (abs(x - x0) < 0.001)
+        hit &= abs(y - wsElev) < 0.001
+        # a vertical segment only intersects if the water surface is within its elevation range
+        vertical = x1 == x0
+        hit &= ~vertical | ((np.minimum(y0, y1) <= y) & (y <= np.maximum(y0, y1)))
+    return np.column_stack((x[hit], y[hit], dist[hit]))
+
 def polygonArea(corners):
     area = 0.0
     for i in range(len(corners)):
@@ -72,65 +160,246 @@ def channelPerimeter(corners): # ajh should be faster to calculate this from the
     for i in range(len(corners)-1):
         P += np.sqrt((np.power((corners[i+1][0]-corners[i][0]),2) + np.power((corners[i+1][1]-corners[i][1]),2)))
     return P
-    
+
+
+def trapezoidEstimator(wsDepth, n, channelSlope, widthBottom, rightSS, leftSS, units=None):
+    """
+    Estimates uniform flow using the Manning equation for a trapezoidal channel
+    directly from the closed form area, wetted perimeter and top width, without
+    building the channel.  Any of the depth and channel arguments can be arrays,
+    and returns R, P, area, topWidth, Q, v and depth (nan where depth <= 0)
+    """
+    const = manningConstant(units)
+    wsDepth = np.where(np.asarray(wsDepth, dtype=float) > 0, wsDepth, np.nan)
+    area = wsDepth*(widthBottom + (leftSS + rightSS)/2.*wsDepth)
+    P = widthBottom + wsDepth*(np.sqrt(1. + leftSS*leftSS) + np.sqrt(1. + rightSS*rightSS))
+    topWidth = widthBottom + (leftSS + rightSS)*wsDepth
+    R = area/P
+    v = (const/n)*np.power(R,(2./3.0))*np.sqrt(channelSlope)
+    Q = v*area
+    # [()] turns 0-d arrays back into scalars when everything passed in was a scalar
+    return R[()], P[()], area[()], topWidth[()], Q[()], v[()], wsDepth[()]
+
+
+class CrossSection(object):
+    """
+    A station/elevation profile prepared for solving, so the thalweg, banks and
+    cumulative distance are only worked out once when the section is loaded,
+    not every time the water surface elevation changes.
+    Can be passed to flowEstimator and flowEstimatorBatch as staElev.
+    """
+
+    def __init__(self, staElev):
+        staElev = np.asarray(staElev, dtype=float)
+        if staElev.ndim != 2 or staElev.shape[1] < 2 or len(staElev) < 3:
+            raise ValueError('A cross section needs at least three station/elevation pairs')
+        if not np.isfinite(staElev[:,:2]).all():
+            raise ValueError('Cross section contains missing elevations')
+        self.staElev = addDistance(staElev)
+        self.station = self.staElev[:,0]
+        self.elevation = self.staElev[:,1]
+        self.distance = self.staElev[:,2]
+
+        self.thalweg = int(np.argmin(self.elevation)) # index of the first lowest point
+        self.minElev = self.elevation[self.thalweg]
+        self.maxElev = self.elevation.max()
+        self.thalwegStation = self.station[self.thalweg]
+        self.thalwegDistance = self.distance[self.thalweg]
+        if self.thalweg == 0 or self.thalweg == len(self.staElev) - 1:
+            raise ValueError('Channel not found')
+        self.leftCrest = self.elevation[:self.thalweg].max()
+        self.rightCrest = self.elevation[self.thalweg+1:].max()
+        self.crestElev = min(self.leftCrest, self.rightCrest) # highest WSE that stays in the channel
+        if self.crestElev <= self.minElev:
+            # flat out to one bank, so there's nothing to hold any water
+            raise ValueError('Channel not found')
+
+        self.segSta = np.diff(self.station)
+        self.segElev = np.diff(self.elevation)
+        self.segLength = np.diff(self.distance)
+        # highest point between the thalweg and each vertex, working outwards; the water surface
+        # meets each bank on the segment outside the nearest vertex that is at or above the stage
+        self.leftMax = np.maximum.accumulate(self.elevation[self.thalweg::-1])[1:]
+        self.rightMax = np.maximum.accumulate(self.elevation[self.thalweg:])[1:]
+        # shoelace cross products relative to the thalweg, to limit float error on large coordinates
+        self.relSta = self.station - self.thalwegStation
+        self.relElev = self.elevation - self.minElev
+        x = self.relSta
+        y = self.relElev
+        self.cross = np.concatenate(([0.0], np.cumsum(x[:-1]*y[1:] - x[1:]*y[:-1])))
+        self._table = None
+
+    def waterline(self, wsElevs, side='left'):
+        """
+        Finds where the water surface meets each bank for an array of water
+        surface elevations.  Returns whether it meets both banks, the bank
+        vertices outside each end, and the station (relative to the thalweg)
+        and distance of each end.  With side='right' an elevation exactly at a
+        high point between the thalweg and a bank counts as overtopping it.
+        """
+        p = np.searchsorted(self.leftMax, wsElevs, side=side)
+        q = np.searchsorted(self.rightMax, wsElevs, side=side)
+        solved = (p < len(self.leftMax)) & (q < len(self.rightMax))
+        left = self.thalweg - 1 - np.minimum(p, len(self.leftMax) - 1) # the water surface is on the segment to the right of this vertex
+        right = self.thalweg + 1 + np.minimum(q, len(self.rightMax) - 1) # the water surface is on the segment to the left of this vertex
+        h = wsElevs - self.minElev
+        # where a bank can't be found the indices are clipped and the results are junk, but
+        # calculating them anyway is quicker than picking out the elevations that can be solved
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fLeft = (self.relElev[left] - h) / -self.segElev[left]
+            fRight = (h - self.relElev[right-1]) / self.segElev[right-1]
+            xLeft = self.relSta[left] + fLeft*self.segSta[left]
+            xRight = self.relSta[right-1] + fRight*self.segSta[right-1]
+            dLeft = self.distance[left] + fLeft*self.segLength[left]
+            dRight = self.distance[right-1] + fRight*self.segLength[right-1]
+        return solved, left, right, xLeft, xRight, dLeft, dRight
+
+    def hydraulics(self, wsElevs, side='left'):
+        """
+        Returns whether each water surface elevation in an array can be solved,
+        and the flow area, wetted perimeter and top width for each.  The area is
+        the shoelace formula, using the cached cross products for the vertices
+        under water.
+        """
+        wsElevs = np.asarray(wsElevs, dtype=float)
+        solved, left, right, xLeft, xRight, dLeft, dRight = self.waterline(wsElevs, side)
+        if side == 'left':
+            solved &= wsElevs > self.minElev
+        else:
+            # just above the thalweg is fine, and gives the width of a flat bottom
+            solved &= wsElevs >= self.minElev
+        x = self.relSta
+        y = self.relElev
+        h = wsElevs - self.minElev
+        # the junk ends of elevations that can't be solved can be inf (from a flat segment), so inf - inf is expected here
+        with np.errstate(invalid='ignore'):
+            area2 = (xLeft*y[left+1] - x[left+1]*h) + (self.cross[right-1] - self.cross[left+1]) + (x[right-1]*h - xRight*y[right-1]) + (xRight - xLeft)*h
+            area = np.where(solved, np.abs(area2)/2.0, np.nan)
+            P = np.where(solved, dRight - dLeft, np.nan)
+            topWidth = np.where(solved, xRight - xLeft, np.nan)
+        return solved, area, P, topWidth
+
+    def conveyanceTable(self):
+        """
+        Returns the ConveyanceTable for this section, building it the first time
+        it is needed.  The section never changes once it is prepared, so the
+        table is kept with it and shared by everything solving the same section.
+        """
+        if self._table is None:
+            self._table = ConveyanceTable(self)
+        return self._table
+
+
+class ConveyanceTable(object):
+    """
+    Flow area, wetted perimeter and top width of a CrossSection at every
+    breakpoint (an elevation where the water surface starts to overtop a high
+    point, so the bank segments change).  Between two breakpoints top width and
+    wetted perimeter are linear in stage and area is quadratic, so any water
+    surface elevation can be answered exactly with a binary search, whatever
+    n, slope and units are.
+    """
+
+    def __init__(self, section):
+        self.section = section
+        # the bank segments only change when the stage passes one of the running maxima, so sort those once
+        breaks = np.unique(np.concatenate((section.leftMax, section.rightMax)))
+        self.breaks = np.concatenate(([section.minElev], breaks[(breaks > section.minElev) & (breaks <= section.crestElev)]))
+        # CrossSection rejects a crest level with the thalweg, and the crest is one of the maxima, so there is always an interval
+        self.dh = np.diff(self.breaks)
+        # we only need the geometry just above each breakpoint and just below the next one
+        # (area can jump at a breakpoint, when a dry pocket behind a high point floods)
+        solved, self.areaAbove, self.PAbove, self.topWidthAbove = section.hydraulics(self.breaks[:-1], side='right')
+        solved, self.areaBelow, self.PBelow, self.topWidthBelow = section.hydraulics(self.breaks[1:], side='left')
+
+    def geometry(self, wsElevs):
+        """
+        Returns whether each water surface elevation in an array can be solved,
+        and the flow area, wetted perimeter and top width for each.
+        """
+        wsElevs = np.asarray(wsElevs, dtype=float)
+        i = np.searchsorted(self.breaks, wsElevs, side='left') - 1 # stage is in (breaks[i], breaks[i+1]]
+        solved = (i >= 0) & (i < len(self.dh))
+        i = np.clip(i, 0, len(self.dh) - 1)
+        dz = wsElevs - self.breaks[i]
+        t = dz/self.dh[i]
+        topWidth = np.where(solved, self.topWidthAbove[i] + t*(self.topWidthBelow[i] - self.topWidthAbove[i]), np.nan)
+        P = np.where(solved, self.PAbove[i] + t*(self.PBelow[i] - self.PAbove[i]), np.nan)
+        area = np.where(solved, self.areaAbove[i] + dz*(self.topWidthAbove[i] + topWidth)/2., np.nan)
+        return solved, area, P, topWidth
+
+    def lookup(self, wsElevs, n, channelSlope, units=None):
+        """
+        Solves the Manning equation for an array of water surface elevations
+        using the table.  Returns R, P, area, topWidth, Q, v and depth like
+        flowEstimatorBatch, with nan where an elevation can't be solved.
+        """
+        wsElevs = np.asarray(wsElevs, dtype=float)
+        solved, area, P, topWidth = self.geometry(wsElevs)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            R = area/P
+            K = area*np.power(R,(2./3.0)) # conveyance
+            Q = (manningConstant(units)/n)*K*np.sqrt(channelSlope)
+            v = Q/area
+        depth = np.where(solved, wsElevs - self.section.minElev, np.nan)
+        return R, P, area, topWidth, Q, v, depth
+
+    def jumps(self, n, channelSlope, units=None):
+        """
+        Returns arrays of the breakpoints where the discharge jumps up (because
+        a dry pocket behind a high point floods, adding to the flow area all at
+        once), and the discharge just below and just above each.  A discharge in
+        one of these gaps has no normal depth.
+        """
+        const = (manningConstant(units)/n)*np.sqrt(channelSlope)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            QBelow = const*self.areaBelow[:-1]*np.power(self.areaBelow[:-1]/self.PBelow[:-1], 2./3.)
+            QAbove = const*self.areaAbove[1:]*np.power(self.areaAbove[1:]/self.PAbove[1:], 2./3.)
+        jump = QAbove > QBelow*(1. + 1e-9)
+        return self.breaks[1:-1][jump], QBelow[jump], QAbove[jump]
+
 
 def flowEstimator(wsElev, n, channelSlope, **kwargs):
     """
     Estimates uniform flow using the Manning equation for
     a user defined trapezoidal channel or a manually defined channel using
     a station/elevation file 
+    A raw station/elevation/distance array is solved by intersecting the water
+    surface with every segment, keeping the original 0.001 tolerance; within
+    that of a vertex it can pick up the next segment instead, e.g. missing a
+    flat bench the water has only just covered.  A CrossSection finds the banks
+    exactly, so use one where that matters.
     """
     # ajh: TODO: I think we could optimise this by assigning variables for things that we are currently looking up repeatedly in the array.  How to confirm if this will improve performance?
-    # ajh: TODO: we locate the thalweg when we load the profile in doIrregularProfileFlowEstimator; if we did it properly there we could start with that here instead of recalculating every time we run flowEstimator.
     if kwargs.get("elevFile") is not None:	# ajh TODO: it seems like this isn't being used at the moment, the file is loaded in flow_estimator_dialog.py; cleanup?
         staElev = np.genfromtxt(kwargs.get("elevFile"), delimiter = '\t')
     elif kwargs.get("staElev") is not None:
         staElev = kwargs.get("staElev")
     elif kwargs.get("widthBottom") and kwargs.get("rightSS") and kwargs.get("leftSS") > 0:
-        staElev = channelBuilder(wsElev, kwargs.get("rightSS"), kwargs.get("leftSS"), kwargs.get("widthBottom"))
+        # closed form, so we only need to build the channel for plotting
+        rightSS = kwargs.get("rightSS")
+        leftSS = kwargs.get("leftSS")
+        R, P, area, topWidth, Q, v, maxDepth = trapezoidEstimator(wsElev, n, channelSlope, kwargs.get("widthBottom"), rightSS, leftSS, kwargs.get("units"))
+        staElev = channelBuilder(wsElev, rightSS, leftSS, kwargs.get("widthBottom"))
+        xGround = staElev[:,0]
+        yGround = staElev[:,1]
+        yGround0 = np.zeros(len(xGround))
+        xWater = np.array([staElev[1,0] - leftSS*wsElev, staElev[1,0], staElev[2,0], staElev[2,0] + rightSS*wsElev])
+        yWater = np.ones(len(xWater))*wsElev
+        yWater0 = np.array([wsElev, 0.0, 0.0, wsElev])
+        args = R, P, area, topWidth, Q, v, maxDepth, xGround, yGround, yGround0, xWater, yWater, yWater0
+        return args
     else:
         QgsMessageLog.logMessage('Whoops, wrong input','Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
         return
-    if kwargs.get("units") == "m":
-        const = 1.0
-    else:
-        const = 1.4859
+    const = manningConstant(kwargs.get("units"))
     
-    minElev = np.min(staElev[:,1]) # could come from doIrregularProfileFlowEstimator, so we would only calculate it once
+    if isinstance(staElev, CrossSection):
+        return sectionEstimator(wsElev, n, channelSlope, staElev, kwargs.get("units"))
+    minElev = np.min(staElev[:,1])
+    staMinElev = np.median(staElev[np.where(staElev[:,1]==minElev)][0][2])
     
-    intersectList = []
-    for i in range(1, len(staElev)):
-        #alister: used this for testing
-        #log('i' + str(i))
-        x, y = lineIntersection((staElev[i-1][:2], staElev[i][:2]), ([staElev[0][0],wsElev], [staElev[-1][0],wsElev]))
-        d = staElev[i-1][2] + ( (y-staElev[i-1][1])**2 + (x-staElev[i-1][0])**2 )**0.5
-        #log('x1' + str(x))
-        #log('y1' + str(y))
-        #log('d' + str(d))
-        #log('staElev' + str(staElev[i-1][0]))
-        #log('staElev' + str(staElev[i][0]))
-        if staElev[i-1][0] <= x <= staElev[i][0] or staElev[i-1][0] >= x >= staElev[i][0] or abs(x - staElev[i][0]) < 0.001 or abs(x - staElev[i-1][0]) < 0.001: # or np.is_close(x, staElev[i-1][0]) or np.is_close(x, staElev[i][0]): # not sure why it didn't like this method to catch any float error
-            #log('yes')
-            if abs(y - wsElev)<0.001: # ajh: was 0.01, but not sure if we need this test; I think it may not have been doing what Mitch intended
-                #log('yes')
-                if staElev[i,0] == staElev[i-1,0]:
-                    #log('yes')
-                    if min(staElev[i,1], staElev[i-1,1]) <= y <= max(staElev[i,1], staElev[i-1,1]): # ajh: how to know if float error will cause a problem here?
-                        intersectList.append((x,y,d))
-                        #log('yes')
-                    else:
-                        log('line segments do not intersect')
-                else:
-                    #log('no')
-                    intersectList.append((x,y,d))
-            log('x' + str(x))
-            log('y' + str(y))
-            log('d' + str(d))
-        else:
-            #alister: used this for testing
-            #log('line segments do not intersect')
-            pass
-    intersectArray = np.array(intersectList)
+    intersectArray = waterlineIntersections(staElev, wsElev)
     if len(intersectArray) < 2:
         QgsMessageLog.logMessage('Programming Error: less than 2 points intersect; how did the WSE get too high?','Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
         log('intersectArray\n ' + str(intersectArray))
@@ -149,8 +418,7 @@ def flowEstimator(wsElev, n, channelSlope, **kwargs):
         #log("002 " + str(np.where(intersectArray[:,0]<=staMinElev)))
         #log("003 " + str(intersectArray[:,0]>=staMinElev))
         #log("003 " + str(np.where(intersectArray[:,0]>=staMinElev)))
-    # don't  put this in the if above; if something has gone wrong we could have two points at the same elevation on the same side of the thalweg, so we should still use this logic for only two points.
-    staMinElev = np.median(staElev[np.where(staElev[:,1]==minElev)][0][2])
+    # don't  put the thalweg search in the if above; if something has gone wrong we could have two points at the same elevation on the same side of the thalweg, so we should still use this logic for only two points.
     #log('staminElev ' + str(staMinElev))
     try:
         startPoint = intersectArray[np.where(intersectArray[:,2]<staMinElev)][-1]
@@ -212,7 +480,7 @@ def flowEstimator(wsElev, n, channelSlope, **kwargs):
     topWidth = staMax-staMin
     xGround = staElev[:,0]
     yGround = staElev[:,1]
-    yGround0 = np.ones(len(xGround))*np.min(yGround)     
+    yGround0 = np.ones(len(xGround))*minElev
     xWater = staElevTrim[:,0]
     yWater = np.ones(len(xWater))*wsElev
     yWater0 = staElevTrim[:,1]  
@@ -220,6 +488,234 @@ def flowEstimator(wsElev, n, channelSlope, **kwargs):
     return args
 
 
+def sectionEstimator(wsElev, n, channelSlope, section, units=None):
+    """
+    flowEstimator for a CrossSection.  The hydraulics come from the section's
+    conveyance table, and the banks from the running maxima found when the
+    section was loaded, so only the water polygon for the plot depends on the
+    number of points.
+    """
+    R, P, area, topWidth, Q, v, maxDepth = [value[()] for value in section.conveyanceTable().lookup(wsElev, n, channelSlope, units)]
+    solved, left, right, xLeft, xRight, dLeft, dRight = section.waterline(wsElev)
+    if not solved or np.isnan(Q):
+        QgsMessageLog.logMessage('Programming Error: the water surface does not meet both banks; how did the WSE get too high?','Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
+        return
+    xGround = section.station
+    yGround = section.elevation
+    yGround0 = np.ones(len(xGround))*section.minElev
+    xWater = np.concatenate(([xLeft + section.thalwegStation], section.station[left+1:right], [xRight + section.thalwegStation]))
+    yWater = np.ones(len(xWater))*wsElev
+    yWater0 = np.concatenate(([wsElev], section.elevation[left+1:right], [wsElev]))
+    args = R, P, area, topWidth, Q, v, maxDepth, xGround, yGround, yGround0, xWater, yWater, yWater0
+    return args
+
+
+def flowEstimatorBatch(wsElevs, n, channelSlope, **kwargs):
+    """
+    Estimates uniform flow using the Manning equation for an array of water
+    surface elevations (or depths, for a trapezoidal channel) in one call.
+    Takes the same keyword arguments as flowEstimator, and returns arrays of
+    R, P, area, topWidth, Q, v and depth, which are nan for any elevation that
+    can't be solved.
+    """
+    wsElevs = np.asarray(wsElevs, dtype=float)
+    if kwargs.get("staElev") is not None:
+        section = kwargs.get("staElev")
+    elif kwargs.get("widthBottom") and kwargs.get("rightSS") and kwargs.get("leftSS") > 0:
+        return trapezoidEstimator(wsElevs, n, channelSlope, kwargs.get("widthBottom"), kwargs.get("rightSS"), kwargs.get("leftSS"), kwargs.get("units"))
+    else:
+        QgsMessageLog.logMessage('Whoops, wrong input','Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
+        return
+    if not isinstance(section, CrossSection):
+        section = CrossSection(section)
+    const = manningConstant(kwargs.get("units"))
+
+    # everything up to here only depends on the section, and is cached by CrossSection
+    solved, area, P, topWidth = section.hydraulics(wsElevs)
+    if not solved.all():
+        QgsMessageLog.logMessage('could not solve for {0} of {1} water surface elevations; below the thalweg or above a bank?'.format(np.count_nonzero(~solved), len(wsElevs)),'Flow Estimator') # default is warning (1)
+    h = wsElevs - section.minElev
+    with np.errstate(divide='ignore', invalid='ignore'):
+        R = area/P
+        v = (const/n)*np.power(R,(2./3.0))*np.sqrt(channelSlope)
+        Q = v*area
+    depth = np.where(solved, h, np.nan)
+    return R, P, area, topWidth, Q, v, depth
+
+
+def normalDepthEstimator(Q, n, channelSlope, **kwargs):
+    """
+    Estimates the normal depth water surface elevation (or depth, for a
+    trapezoidal channel) for a discharge, or an array of discharges, using the
+    Manning equation.  Takes the same keyword arguments as flowEstimator, and
+    returns nan for any discharge that the channel can't carry, or that falls
+    in a jump in the discharge (see ConveyanceTable.jumps).
+    """
+    xtol = kwargs.pop("xtol", 1e-6)
+    Qtarget = np.atleast_1d(np.asarray(Q, dtype=float))
+    if kwargs.get("staElev") is not None:
+        section = kwargs.get("staElev")
+        if not isinstance(section, CrossSection):
+            section = CrossSection(section)
+        kwargs["staElev"] = section
+        lo = np.full(Qtarget.shape, section.minElev)
+        hi = np.full(Qtarget.shape, section.crestElev)
+    elif kwargs.get("widthBottom") and kwargs.get("rightSS") and kwargs.get("leftSS") > 0:
+        lo = np.zeros(Qtarget.shape)
+        hi = np.ones(Qtarget.shape)
+        # a trapezoid has no top, so keep doubling the depth until it carries enough
+        for i in range(60):
+            short = flowEstimatorBatch(hi, n, channelSlope, **kwargs)[4] < Qtarget
+            if not short.any():
+                break
+            hi = np.where(short, hi*2., hi)
+    else:
+        QgsMessageLog.logMessage('Whoops, wrong input','Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
+        return
+
+    # Q is close to proportional to depth^(5/3) for most channels, so solving for Q^(3/5) makes the
+    # function nearly linear and regula falsi converges in a few evaluations
+    # each pass evaluates every discharge at once with flowEstimatorBatch
+    gap = np.zeros(Qtarget.shape, dtype=bool)
+    if kwargs.get("staElev") is not None:
+        # the discharge jumps past anything between the two sides of a jump, so there is no stage to converge on
+        stages, QBelow, QAbove = section.conveyanceTable().jumps(n, channelSlope, kwargs.get("units"))
+        gap = ((Qtarget[:,None] > QBelow) & (Qtarget[:,None] < QAbove)).any(axis=1)
+        if gap.any():
+            QgsMessageLog.logMessage('{0} of {1} discharges fall where the flow jumps as a dry area floods at {2}, so have no normal depth'.format(np.count_nonzero(gap), len(Qtarget), ', '.join('{0:.3f}'.format(stage) for stage in stages)),'Flow Estimator') # default is warning (1)
+    target = np.power(Qtarget, 0.6)
+    def f(wsElevs):
+        return np.power(flowEstimatorBatch(wsElevs, n, channelSlope, **kwargs)[4], 0.6) - target
+    a = lo
+    fa = -target # no flow at the bottom of the channel
+    b = hi
+    fb = f(hi)
+    solvable = (Qtarget > 0) & (fb >= 0)
+    if not (solvable | gap).all():
+        QgsMessageLog.logMessage('{0} of {1} discharges are zero or more than the channel can carry'.format(np.count_nonzero(~(solvable | gap)), len(Qtarget)),'Flow Estimator') # default is warning (1)
+    solvable &= ~gap
+    # Illinois variant of regula falsi: the root stays bracketed between a and b, but the value at
+    # an end that hasn't moved is halved, so it doesn't creep up on the root from one side
+    for i in range(100):
+        active = solvable & (abs(b - a) > xtol) & (fb != 0)
+        if not active.any():
+            break
+        with np.errstate(divide='ignore', invalid='ignore'):
+            c = b - fb*(b - a)/(fb - fa)
+        c = np.where(np.isfinite(c) & ((c - a)*(c - b) < 0), c, (a + b)/2.)
+        fc = f(c)
+        crossed = fc*fb < 0
+        a, fa = np.where(active & crossed, b, a), np.where(active, np.where(crossed, fb, fa/2.), fa)
+        b, fb = np.where(active, c, b), np.where(active, fc, fb)
+    wsElev = np.where(solvable, b, np.nan)
+    if np.ndim(Q) == 0:
+        return wsElev[0]
+    return wsElev
+
+
+def ratingCurve(n, channelSlope, stages=None, **kwargs):
+    """
+    Builds an exact rating curve, with a row at every breakpoint (an elevation
+    where the water surface starts to overtop a high point, so the bank segments
+    change) plus any requested stages between them.  Takes the same keyword
+    arguments as flowEstimator, and returns arrays of water surface elevation,
+    R, P, area, topWidth, Q, v and depth.
+    """
+    if kwargs.get("staElev") is not None:
+        section = kwargs.get("staElev")
+    elif kwargs.get("widthBottom") and kwargs.get("rightSS") and kwargs.get("leftSS") > 0:
+        # a trapezoid has no breakpoints above the bed, so the requested stages are all there is
+        wsElevs = np.unique(stages)
+        return (wsElevs,) + trapezoidEstimator(wsElevs, n, channelSlope, kwargs.get("widthBottom"), kwargs.get("rightSS"), kwargs.get("leftSS"), kwargs.get("units"))
+    else:
+        QgsMessageLog.logMessage('Whoops, wrong input','Flow Estimator', 2) # 2 is level=Qgis.Critical in QGIS3
+        return
+    if not isinstance(section, CrossSection):
+        section = CrossSection(section)
+    table = section.conveyanceTable()
+    breaks = table.breaks
+
+    if stages is None:
+        wsElevs = breaks[1:]
+    else:
+        stages = np.asarray(stages, dtype=float)
+        wsElevs = np.union1d(stages, breaks[1:][(breaks[1:] >= stages.min()) & (breaks[1:] <= stages.max())])
+    R, P, area, topWidth, Q, v, depth = table.lookup(wsElevs, n, channelSlope, kwargs.get("units"))
+    if np.isnan(area).any():
+        QgsMessageLog.logMessage('could not solve for {0} of {1} water surface elevations; below the thalweg or above a bank?'.format(np.count_nonzero(np.isnan(area)), len(wsElevs)),'Flow Estimator') # default is warning (1)
+    return wsElevs, R, P, area, topWidth, Q, v, depth
+
+
+def adaptiveStages(discharge, wseMin, wseMax, tolerance=0.01, minStep=0.01, maxStep=1.0):
+    """
+    Picks stages from wseMin to wseMax for a rating curve, so it has points where
+    the curve bends rather than at a fixed step.  Starts with stages no more than
+    maxStep apart, and halves any interval where interpolating between its ends
+    misses the discharge at its midpoint by more than tolerance (a fraction of
+    that discharge), as long as the halves are no smaller than minStep.
+    discharge is a function returning Q for an array of stages.
+    Returns arrays of the stages and their discharges.
+    """
+    count = max(1, int(np.ceil((wseMax - wseMin)/maxStep)))
+    stages = np.linspace(wseMin, wseMax, count + 1)
+    Q = discharge(stages)
+    # only intervals that were just split need checking again
+    pending = np.ones(len(stages) - 1, dtype=bool)
+    while True:
+        check = pending & (np.diff(stages)/2. >= minStep)
+        if not check.any():
+            break
+        mids = ((stages[:-1] + stages[1:])/2.)[check]
+        Qmid = discharge(mids)
+        with np.errstate(invalid='ignore'):
+            split = abs(Qmid - (Q[:-1][check] + Q[1:][check])/2.) > tolerance*abs(Qmid)
+        if not split.any():
+            break
+        inserted = np.concatenate((np.zeros(len(stages), dtype=bool), np.ones(np.count_nonzero(split), dtype=bool)))
+        stages = np.concatenate((stages, mids[split]))
+        Q = np.concatenate((Q, Qmid[split]))
+        order = np.argsort(stages, kind='mergesort')
+        stages = stages[order]
+        Q = Q[order]
+        inserted = inserted[order]
+        pending = inserted[:-1] | inserted[1:]
+    return stages, Q
+
+
+
+def reachTable(centerDist, stations, elevations, discharge, n, channelSlope, units=None, tolerance=None):
+    """
+    Solves the normal depth for a discharge at every cross section along a
+    reach, given as the distance of each along the centerline, the station of
+    each point across them, and an array of elevations with a row per section
+    (as from transectSampler).  With a tolerance each section is simplified
+    first (see simplifySection).  Returns arrays of centerline distance, water
+    surface elevation, R, P, area, topWidth, Q, v and depth, with nan for a
+    section that is off the DEM, has no channel, or can't carry the discharge
+    (including one where the discharge jumps past it, see ConveyanceTable.jumps).
+    """
+    centerDist = np.asarray(centerDist, dtype=float)
+    results = np.full((len(centerDist), 8), np.nan)
+    for i, elevation in enumerate(elevations):
+        staElev = np.column_stack((stations, elevation))
+        if tolerance is not None and np.isfinite(staElev).all():
+            staElev = simplifySection(staElev, tolerance)
+        try:
+            section = CrossSection(staElev)
+        except ValueError:
+            continue
+        wsElev = normalDepthEstimator(discharge, n, channelSlope, staElev=section, units=units)
+        if wsElev is None or np.isnan(wsElev):
+            continue
+        # a discharge inside a jump (where a dry pocket floods) has no normal depth and is skipped above, so the
+        # table gives back the discharge asked for, to within the solver's tolerance on the stage
+        results[i,0] = wsElev
+        results[i,1:] = np.concatenate(section.conveyanceTable().lookup([wsElev], n, channelSlope, units))
+    unsolved = np.count_nonzero(np.isnan(results[:,0]))
+    if unsolved:
+        QgsMessageLog.logMessage('could not solve {0} of {1} sections along the reach'.format(unsolved, len(centerDist)),'Flow Estimator') # default is warning (1)
+    return (centerDist,) + tuple(results.T)
+
 #def plotter(args):
 #    R, area, topWidth, Q, v, xGround, yGround, yGround0, xWater, yWater, yWater0 = args
 #    plt.plot(xGround, yGround, '0.9')
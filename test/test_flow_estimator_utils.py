@@ -0,0 +1,299 @@
+# coding=utf-8
+"""DEM sampling test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'alister.hood@gmail.com'
+__date__ = '2026-10-18'
+__copyright__ = 'Copyright 2015, M. Weier - North Dakota State Water Commission'
+
+import os
+import tempfile
+import unittest
+
+import numpy as np
+try:
+    from qgis.core import QgsCoordinateReferenceSystem, QgsCoordinateTransform, QgsPointXY, QgsProject, QgsRasterLayer, QgsVectorLayer
+except ImportError:
+    raise unittest.SkipTest('these tests sample real rasters, so they need QGIS')
+from shapely.geometry import LineString
+
+from .utilities import get_qgis_app
+QGIS_APP = get_qgis_app()
+
+import FlowEstimator_utils
+from FlowEstimator_utils import LineLayerIndex, RasterLayerIndex, RatingCurveTask, ResultCache, SamplingTask, SolveTask, TileCache, elevationSampler, fingerprint, frange, lineStations, pixelCrossings, previewSize, rescaleDistances, sampleRaster, tileChunks, transectSampler, transects, transformPoints, valRaster, writeRatingCurve
+
+
+class FlowEstimatorUtilsTest(unittest.TestCase):
+    """Test sampling elevations from a DEM."""
+
+    def setUp(self):
+        """Runs before each test."""
+        # ten by ten cells of 10 units, each with the value of its column
+        path = os.path.join(os.path.dirname(__file__), 'tenbytenraster.asc')
+        self.layer = QgsRasterLayer(path, 'TestRaster')
+
+    def test_sample_raster_matches_identify(self):
+        """Test block sampling gives the same values as identify."""
+        xs = np.linspace(1535376, 1535474, 23)
+        ys = np.linspace(5083354, 5083256, 23)
+        z = sampleRaster(xs, ys, self.layer)
+        for x, y, value in zip(xs, ys, z):
+            self.assertEqual(value, valRaster(x, y, self.layer))
+
+    def test_sample_raster_outside(self):
+        """Test points outside the raster are nan."""
+        z = sampleRaster([1535300, 1535400], [5083300, 5083300], self.layer)
+        self.assertTrue(np.isnan(z[0]))
+        self.assertEqual(z[1], 2)
+
+    def test_line_stations(self):
+        """Test stations along a polyline match shapely's interpolate."""
+        line = LineString([(0, 0), (30, 40), (30, 40), (90, 40), (60, 0)])
+        x, y, dist = lineStations(line.coords, 7.5)
+        stations = list(frange(0, line.length, 7.5))
+        np.testing.assert_allclose(dist, stations)
+        np.testing.assert_allclose(x, [line.interpolate(d).x for d in stations], atol=1e-9)
+        np.testing.assert_allclose(y, [line.interpolate(d).y for d in stations], atol=1e-9)
+
+    def test_elevation_sampler(self):
+        """Test a line across the raster is sampled at the requested spacing."""
+        line = LineString([(1535376, 5083300), (1535470, 5083300)])
+        x, y, z, dist = elevationSampler(line, 10, self.layer)
+        np.testing.assert_allclose(dist, [0, 10, 20, 30, 40, 50, 60, 70, 80, 90, 94])
+        np.testing.assert_array_equal(z, [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 9])
+
+    def test_pixel_crossings(self):
+        """Test a diagonal line gets a station at every pixel edge it crosses, with the value of the pixel it enters."""
+        line = LineString([(1535376, 5083352), (1535434, 5083307)])
+        x, y, dist = pixelCrossings(line.coords, self.layer)
+        # 5 vertical and 4 horizontal grid lines, plus the ends
+        self.assertEqual(len(dist), 11)
+        x, y, z, dist = elevationSampler(line, 10, self.layer, crossings=True)
+        np.testing.assert_array_equal(z, [0, 1, 1, 2, 2, 3, 3, 4, 4, 5, 5])
+
+    def test_interpolation(self):
+        """Test bilinear and bicubic interpolation between pixel centres, and nearest at the edge."""
+        xs = [1535385, 1535402.5, 1535376]
+        ys = [5083300, 5083300, 5083300]
+        np.testing.assert_allclose(sampleRaster(xs, ys, self.layer, interpolation='bilinear'), [0.5, 2.25, 0])
+        # the values are linear, so bicubic agrees away from the edges
+        np.testing.assert_allclose(sampleRaster(xs[:2], ys[:2], self.layer, interpolation='bicubic'), [0.5, 2.25])
+
+    def test_tile_cache(self):
+        """Test tiles are read once, and read again after the cache is invalidated."""
+        cache = TileCache()
+        first = cache.tile(self.layer, 1, 0, 0)
+        self.assertIs(cache.tile(self.layer, 1, 0, 0), first)
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(cache.bytes, first.nbytes)
+        cache.invalidate(self.layer.id())
+        self.assertEqual(cache.bytes, 0)
+        cache.tile(self.layer, 1, 0, 0)
+        self.assertEqual(cache.misses, 2)
+        # reading doesn't connect to the layer, as it may be on a worker thread
+        self.assertEqual(cache.watched, set())
+        cache.watch(self.layer)
+        self.layer.dataChanged.emit()
+        self.assertEqual(cache.bytes, 0)
+
+    def test_sampling_task_watches_layer(self):
+        """Test the sampling task watches the layer for changes when it is made, rather than from the thread it runs in."""
+        SamplingTask(LineString([(1535376, 5083354), (1535474, 5083256)]), 10, self.layer)
+        self.assertIn(self.layer.id(), FlowEstimator_utils.TILE_CACHE.watched)
+
+    def test_tile_cache_limit(self):
+        """Test the least recently used tile is dropped when the cache is full."""
+        cache = TileCache()
+        first = cache.tile(self.layer, 1, 0, 0)
+        cache.maxBytes = first.nbytes
+        cache.tile(self.layer, 2, 0, 0)
+        self.assertEqual(list(cache.tiles), [(self.layer.id(), 0, 0, 2)])
+
+    def test_result_cache(self):
+        """Test results are solved once, the least recently used is dropped when the cache is full, and invalidating drops them all."""
+        cache = ResultCache(maxEntries=2)
+        calls = []
+        solve = lambda value: lambda: calls.append(value) or value*2
+        section = fingerprint(np.array([(0., 1.), (1., 0.), (2., 1.)]))
+        self.assertEqual(section, fingerprint(np.array([(0., 1.), (1., 0.), (2., 1.)])))
+        self.assertNotEqual(section, fingerprint(np.array([(0., 1.), (1., 0.5), (2., 1.)])))
+        self.assertEqual(cache.get((section, 1), solve(1)), 2)
+        self.assertEqual(cache.get((section, 1), solve(1)), 2)
+        cache.get((section, 2), solve(2))
+        cache.get((section, 1), solve(1))
+        cache.get((section, 3), solve(3))
+        self.assertEqual(list(cache.results), [(section, 1), (section, 3)])
+        self.assertEqual(calls, [1, 2, 3])
+        self.assertEqual((cache.hits, cache.misses), (2, 3))
+        cache.invalidate()
+        self.assertNotIn((section, 1), cache)
+
+    def test_preview(self):
+        """Test a preview without overviews is read at the requested resolution."""
+        size = previewSize(self.layer, 20)
+        self.assertEqual(size, (5, 5))
+        line = LineString([(1535376, 5083300), (1535470, 5083300)])
+        x, y, z, dist = elevationSampler(line, 20, self.layer, size=size)
+        self.assertEqual(len(dist), 6)
+        self.assertFalse(np.isnan(z).any())
+        x, y, z, dist = elevationSampler(line, 20, self.layer, crossings=True, size=size)
+        # 4 vertical grid lines at the preview resolution, plus the ends
+        self.assertEqual(len(dist), 6)
+
+    def test_sampling_task(self):
+        """Test the sampling task delivers the same section as elevationSampler, and nothing once cancelled."""
+        line = LineString([(1535376, 5083300), (1535470, 5083300)])
+        results = []
+        task = SamplingTask(line, 10, self.layer)
+        task.sampled.connect(results.append)
+        self.assertTrue(task.run())
+        task.finished(True)
+        x, y, z, dist = elevationSampler(line, 10, self.layer)
+        np.testing.assert_array_equal(results[0], np.column_stack((dist, z)))
+        task = SamplingTask(line, 10, self.layer)
+        task.cancel()
+        self.assertFalse(task.run())
+
+    def test_solve_task(self):
+        """Test the solve task passes back its generation with the result, or None if the solver fails."""
+        results = []
+        task = SolveTask(3, lambda a, b=0: a + b, 1, b=2)
+        task.solved.connect(lambda generation, result: results.append((generation, result)))
+        task.finished(task.run())
+        task = SolveTask(4, lambda: 1/0)
+        task.solved.connect(lambda generation, result: results.append((generation, result)))
+        task.finished(task.run())
+        self.assertEqual(results, [(3, 3), (4, None)])
+
+    def test_rating_curve_task(self):
+        """Test the rating curve is written a chunk at a time, without repeating the stage the chunks share, or unsolved rows."""
+        curve = lambda stages: np.column_stack((stages, np.where(stages < 450, stages*2., np.nan)))
+        rows = []
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as outFile:
+            outFile.write('header\n')
+        try:
+            task = RatingCurveTask(outFile.name, lambda: np.arange(500.), curve, ['%.01f', '%.01f'])
+            task.exported.connect(rows.append)
+            task.finished(task.run())
+            written = np.loadtxt(outFile.name, skiprows=1)
+        finally:
+            os.remove(outFile.name)
+        np.testing.assert_array_equal(written[:,0], np.arange(450.))
+        np.testing.assert_array_equal(rows[0], written)
+
+    def test_rating_curve_task_cancelled(self):
+        """Test a cancelled export doesn't write anything else, and writing in the foreground gives the same rows."""
+        curve = lambda stages: np.column_stack((stages, stages*2.))
+        with tempfile.NamedTemporaryFile('w', suffix='.txt', delete=False) as outFile:
+            outFile.write('header\n')
+        try:
+            task = RatingCurveTask(outFile.name, lambda: np.arange(500.), curve, ['%.01f', '%.01f'])
+            task.cancel()
+            self.assertFalse(task.run())
+            with open(outFile.name) as inFile:
+                self.assertEqual(inFile.read(), 'header\n')
+            rows = writeRatingCurve(outFile.name, lambda: np.arange(500.), curve, ['%.01f', '%.01f'])
+            written = np.loadtxt(outFile.name, skiprows=1)
+        finally:
+            os.remove(outFile.name)
+        np.testing.assert_array_equal(rows, written)
+        np.testing.assert_array_equal(written[:,0], np.arange(500.))
+
+    def test_threaded_sampling(self):
+        """Test sampling with a thread pool gives the same section as sampling in one go."""
+        line = LineString([(1535376, 5083354), (1535474, 5083256)])
+        tileSize = FlowEstimator_utils.TILE_SIZE
+        FlowEstimator_utils.TILE_SIZE = 2 # so the line crosses several tiles
+        try:
+            x, y, dist = lineStations(line.coords, 0.01)
+            chunks = tileChunks(x, y, self.layer, 4)
+            self.assertEqual(len(chunks), 4)
+            self.assertEqual(chunks[0][0], 0)
+            self.assertEqual(chunks[-1][1], len(dist))
+            single = elevationSampler(line, 0.01, self.layer, threads=1)
+            threaded = elevationSampler(line, 0.01, self.layer, threads=4)
+        finally:
+            FlowEstimator_utils.TILE_SIZE = tileSize
+        np.testing.assert_array_equal(threaded[2], single[2])
+
+    def test_transform_points(self):
+        """Test transforming arrays at once gives the same points as transforming them one at a time."""
+        transform = QgsCoordinateTransform(QgsCoordinateReferenceSystem('EPSG:4326'), QgsCoordinateReferenceSystem('EPSG:3857'), QgsProject.instance())
+        xs = np.linspace(170, 175, 7)
+        ys = np.linspace(-40, -35, 7)
+        x, y = transformPoints(transform, xs, ys)
+        for xi, yi, xt, yt in zip(xs, ys, x, y):
+            point = transform.transform(QgsPointXY(xi, yi))
+            self.assertAlmostEqual(point.x(), xt, 6)
+            self.assertAlmostEqual(point.y(), yt, 6)
+
+    def test_rescale_distances(self):
+        """Test distances along a line are moved to the same place along each segment of another."""
+        dist = rescaleDistances([(0, 0), (10, 0), (10, 20)], [(0, 0), (20, 0), (20, 10)], [0, 5, 10, 20, 30])
+        np.testing.assert_allclose(dist, [0, 10, 20, 25, 30])
+
+    def test_transects(self):
+        """Test transects are at right angles to the centerline, from its left to its right."""
+        dist, left, right = transects([(0, 0), (0, 30), (0, 30), (40, 30)], 20, 5)
+        np.testing.assert_allclose(dist, [0, 20, 40, 60, 70])
+        np.testing.assert_allclose(left, [(-5, 0), (-5, 20), (10, 35), (30, 35), (40, 35)])
+        np.testing.assert_allclose(right, [(5, 0), (5, 20), (10, 25), (30, 25), (40, 25)])
+
+    def test_transect_sampler(self):
+        """Test every transect is sampled across the raster, and matches sampling it as a line."""
+        centerline = [(1535425, 5083350), (1535425, 5083260)]
+        dist, stations, z = transectSampler(centerline, 30, 35, 10, self.layer)
+        np.testing.assert_allclose(dist, [0, 30, 60, 90])
+        np.testing.assert_allclose(stations, [0, 10, 20, 30, 40, 50, 60, 70])
+        # looking down the centerline (south) the left bank is to the east
+        np.testing.assert_array_equal(z, np.tile([8, 7, 6, 5, 4, 3, 2, 1], (4, 1)))
+        line = LineString([(1535460, 5083320), (1535390, 5083320)])
+        np.testing.assert_array_equal(z[1], elevationSampler(line, 10, self.layer)[2])
+
+    def test_layer_index(self):
+        """Test the layer index follows layers being added, renamed and removed, and stops following removed layers."""
+        project = QgsProject()
+        index = RasterLayerIndex(project)
+        changes = []
+        index.changed.connect(lambda: changes.append(True))
+        project.addMapLayer(self.layer)
+        self.assertEqual(index.names(), ['TestRaster ' + self.layer.crs().authid()])
+        self.assertIs(index.layer('TestRaster'), self.layer)
+        self.layer.setName('Renamed')
+        self.assertIsNone(index.layer('TestRaster'))
+        self.assertIs(index.layer('Renamed'), self.layer)
+        project.takeMapLayer(self.layer) # removed from the project, but not deleted
+        self.assertEqual(index.names(), [])
+        self.layer.setName('Removed')
+        self.assertEqual(len(changes), 3)
+        self.assertEqual(index.renames, {})
+        index.unload()
+
+    def test_line_layer_index(self):
+        """Test the line layer index only follows line layers, sorted by name, and follows renames."""
+        project = QgsProject()
+        index = LineLayerIndex(project)
+        river = QgsVectorLayer('LineString?crs=EPSG:3857', 'River', 'memory')
+        creek = QgsVectorLayer('LineString?crs=EPSG:3857', 'Creek', 'memory')
+        points = QgsVectorLayer('Point?crs=EPSG:3857', 'Gauges', 'memory')
+        project.addMapLayers([river, creek, points, self.layer])
+        self.assertEqual(index.lineLayers(), [creek, river])
+        creek.setName('Stream')
+        self.assertEqual(index.lineLayers(), [river, creek])
+        self.assertIs(index.layer('Stream'), creek)
+        project.removeMapLayer(river.id())
+        self.assertEqual(index.lineLayers(), [creek])
+        index.unload()
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(FlowEstimatorUtilsTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)
@@ -0,0 +1,282 @@
+# coding=utf-8
+"""Open channel hydraulics test.
+
+.. note:: This program is free software; you can redistribute it and/or modify
+     it under the terms of the GNU General Public License as published by
+     the Free Software Foundation; either version 2 of the License, or
+     (at your option) any later version.
+
+"""
+
+__author__ = 'alister.hood@gmail.com'
+__date__ = '2026-10-18'
+__copyright__ = 'Copyright 2015, M. Weier - North Dakota State Water Commission'
+
+import unittest
+import warnings
+
+import numpy as np
+try:
+    from qgis.core import QgsMessageLog # openChannel logs through QGIS
+except ImportError:
+    raise unittest.SkipTest('openChannel needs QGIS')
+
+from openChannel import ConveyanceTable, CrossSection, adaptiveStages, addDistance, channelBuilder, flowEstimator, flowEstimatorBatch, lineIntersection, normalDepthEstimator, ratingCurve, reachTable, simplifySection, trapezoidEstimator, waterlineIntersections
+
+
+class OpenChannelTest(unittest.TestCase):
+    """Test the Manning equation solver."""
+
+    def test_intersections_match_line_intersection(self):
+        """Test the vectorised intersections agree with lineIntersection."""
+        staElev = addDistance([(0, 5), (2, 3), (2, 1), (4, 0), (6, 2), (8, 2), (9, 5)])
+        for wsElev in [0.5, 1.0, 2.0, 2.5, 4.0]:
+            expected = []
+            for i in range(1, len(staElev)):
+                x, y = lineIntersection((staElev[i-1][:2], staElev[i][:2]), ([staElev[0][0], wsElev], [staElev[-1][0], wsElev]))
+                if np.isnan(x) or not (min(staElev[i-1,0], staElev[i,0]) <= x <= max(staElev[i-1,0], staElev[i,0])):
+                    continue
+                if staElev[i,0] == staElev[i-1,0] and not min(staElev[i,1], staElev[i-1,1]) <= y <= max(staElev[i,1], staElev[i-1,1]):
+                    continue
+                expected.append((x, y))
+            result = waterlineIntersections(staElev, wsElev)
+            np.testing.assert_allclose(result[:,:2], np.array(expected).reshape(-1, 2))
+
+    def test_intersections_vertical_segment(self):
+        """Test a vertical wall is only intersected within its elevation range."""
+        staElev = addDistance([(0, 5), (0, 0), (4, 0), (4, 3)])
+        result = waterlineIntersections(staElev, 4.0)
+        self.assertEqual(len(result), 1)
+        self.assertAlmostEqual(result[0,0], 0.0)
+        self.assertAlmostEqual(result[0,2], 1.0)
+
+    def test_intersections_trapezoid(self):
+        """Test the water surface crosses both banks of a trapezoid."""
+        staElev = channelBuilder(1.0, 2.0, 2.0, 3.0)
+        result = waterlineIntersections(staElev, 1.0)
+        np.testing.assert_allclose(result[:,0], [0.5, 7.5])
+
+    def test_batch_matches_flow_estimator(self):
+        """Test the batch solver agrees with flowEstimator at every stage."""
+        staElev = addDistance([(0, 5), (2, 3), (3, 1.5), (4, 0), (6, 2), (7, 1.2), (8, 2.4), (9, 5)])
+        wsElevs = np.linspace(0.1, 4.9, 25)
+        batch = flowEstimatorBatch(wsElevs, 0.035, 0.002, staElev = staElev, units = 'm')
+        for i, wsElev in enumerate(wsElevs):
+            args = flowEstimator(wsElev, 0.035, 0.002, staElev = staElev, units = 'm')
+            np.testing.assert_allclose([b[i] for b in batch], args[:7])
+
+    def test_batch_unsolvable_stages(self):
+        """Test stages below the thalweg or above a bank are nan."""
+        staElev = addDistance([(0, 5), (4, 0), (9, 3)])
+        R, P, area, topWidth, Q, v, depth = flowEstimatorBatch([-1.0, 0.0, 2.0, 4.0], 0.035, 0.002, staElev = staElev, units = 'm')
+        np.testing.assert_array_equal(np.isnan(Q), [True, True, False, True])
+
+    def test_batch_unsolvable_flat_banks(self):
+        """Test stages above flat banks are unsolved without numpy warnings."""
+        section = CrossSection([(0, 5), (1, 5), (2, 0), (3, 5), (4, 5)])
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            solved, area, P, topWidth = section.hydraulics(np.array([2., 6.]))
+        np.testing.assert_array_equal(solved, [True, False])
+        self.assertTrue(np.isnan([area[1], P[1], topWidth[1]]).all())
+
+    def test_batch_trapezoid(self):
+        """Test the batch solver agrees with flowEstimator for a trapezoidal channel."""
+        depths = np.array([0.25, 1.0, 2.5])
+        batch = flowEstimatorBatch(depths, 0.03, 0.001, widthBottom = 3.0, rightSS = 2.0, leftSS = 1.5, units = 'ft')
+        for i, depth in enumerate(depths):
+            args = flowEstimator(depth, 0.03, 0.001, widthBottom = 3.0, rightSS = 2.0, leftSS = 1.5, units = 'ft')
+            np.testing.assert_allclose([b[i] for b in batch], args[:7])
+
+    def test_trapezoid_matches_polygon(self):
+        """Test the closed form trapezoid agrees with solving the built channel."""
+        for depth in [0.05, 1.0, 4.2]:
+            expected = flowEstimator(depth, 0.03, 0.001, staElev = channelBuilder(depth, 2.0, 1.5, 3.0), units = 'm')
+            result = trapezoidEstimator(depth, 0.03, 0.001, 3.0, 2.0, 1.5, 'm')
+            np.testing.assert_allclose(result, expected[:7])
+
+    def test_trapezoid_broadcasts(self):
+        """Test the closed form trapezoid works over arrays of depths and channels."""
+        depths = np.array([[0.5], [1.0]])
+        widths = np.array([1.0, 2.0, 3.0])
+        Q = trapezoidEstimator(depths, 0.03, 0.001, widths, 2.0, 1.5, 'm')[4]
+        self.assertEqual(Q.shape, (2, 3))
+        self.assertAlmostEqual(Q[1,2], trapezoidEstimator(1.0, 0.03, 0.001, 3.0, 2.0, 1.5, 'm')[4])
+
+    def test_cross_section(self):
+        """Test the thalweg, banks and distance are found when a section is prepared."""
+        section = CrossSection([(0, 5), (3, 1), (4, 0), (5, 0), (9, 3)])
+        self.assertEqual(section.thalweg, 2)
+        self.assertEqual(section.minElev, 0)
+        self.assertEqual(section.maxElev, 5)
+        self.assertEqual(section.leftCrest, 5)
+        self.assertEqual(section.rightCrest, 3)
+        self.assertEqual(section.crestElev, 3)
+        np.testing.assert_allclose(section.distance, [0, 5, 5 + 2**0.5, 6 + 2**0.5, 11 + 2**0.5])
+
+    def test_cross_section_invalid(self):
+        """Test sections without a channel are rejected."""
+        self.assertRaises(ValueError, CrossSection, [(0, 0), (1, 1), (2, 2)])
+        self.assertRaises(ValueError, CrossSection, [(0, 2), (1, np.nan), (2, 2)])
+        self.assertRaises(ValueError, CrossSection, [(0, 2), (1, 0)])
+        self.assertRaises(ValueError, CrossSection, [(0, 2), (1, 0), (2, 0)])
+
+    def test_cross_section_matches_array(self):
+        """Test flowEstimator gives the same answer for a prepared section and a raw array, including flat bottoms and the water surface exactly at a vertex."""
+        cases = [([(0, 5), (2, 3), (4, 0), (6, 2), (9, 5)], [0.5, 2, 2.5, 3, 4.5, 5]),
+                 ([(0, 5), (2, 1), (4, 1), (6, 5)], [1.0005, 1.5, 3, 5]), # flat bottom
+                 ([(0, 5), (2, 3), (3, 3), (4, 0), (6, 2), (8, 2), (9, 5)], [1, 2, 2.5, 3, 4])] # flat benches
+        for points, wsElevs in cases:
+            staElev = addDistance(points)
+            section = CrossSection(points)
+            for wsElev in wsElevs:
+                expected = flowEstimator(wsElev, 0.035, 0.002, staElev = staElev, units = 'm')
+                result = flowEstimator(wsElev, 0.035, 0.002, staElev = section, units = 'm')
+                np.testing.assert_allclose(result[:7], expected[:7])
+        # no flow area with the water surface on a flat bottom
+        flat = [(0, 5), (2, 1), (4, 1), (6, 5)]
+        self.assertIsNone(flowEstimator(1, 0.035, 0.002, staElev = addDistance(flat), units = 'm'))
+        self.assertIsNone(flowEstimator(1, 0.035, 0.002, staElev = CrossSection(flat), units = 'm'))
+        # crest level with the thalweg
+        self.assertRaises(ValueError, CrossSection, [(0, 5), (2, 1), (4, 1)])
+
+    def test_cross_section_near_vertex(self):
+        """Test a prepared section floods a bench as soon as the water is above it, where the raw array tolerance stops at its edge."""
+        points = [(0, 5), (2, 3), (3, 3), (4, 0), (6, 2), (8, 2), (9, 5)]
+        wsElev = 2.0005
+        left = 4 - wsElev/3.
+        result = flowEstimator(wsElev, 0.035, 0.002, staElev = CrossSection(points), units = 'm')
+        self.assertAlmostEqual(result[3], 8 + (wsElev - 2)/3. - left)
+        # the raw array path takes the extension of the segment below the bench, within 0.001 of its end
+        expected = flowEstimator(wsElev, 0.035, 0.002, staElev = addDistance(points), units = 'm')
+        self.assertAlmostEqual(expected[3], 6 + (wsElev - 2) - left)
+
+    def test_rating_curve(self):
+        """Test the rating curve has every breakpoint and agrees with the batch solver."""
+        # the high point at 7 floods the pocket on the right when the stage reaches 2
+        section = CrossSection([(0, 5), (2, 3), (4, 0), (6, 1.5), (7, 2), (8, 1), (9, 3), (11, 6)])
+        stages = np.linspace(0.25, 2.75, 11)
+        result = ratingCurve(0.035, 0.002, stages, staElev = section, units = 'm')
+        wsElevs = result[0]
+        for breakpoint in [1.5, 2.0]:
+            self.assertIn(breakpoint, wsElevs)
+        for stage in stages:
+            self.assertIn(stage, wsElevs)
+        expected = flowEstimatorBatch(wsElevs, 0.035, 0.002, staElev = section, units = 'm')
+        np.testing.assert_allclose(result[1:], expected)
+
+    def test_simplify_exact(self):
+        """Test duplicate and collinear points are removed without changing the hydraulics."""
+        staElev = [(0, 5), (1, 4), (2, 3), (2, 3), (3, 1), (4, 0), (4.5, 0), (5, 0), (6, 1), (7, 2), (7, 2), (8, 5)]
+        simplified = simplifySection(staElev)
+        np.testing.assert_array_equal(simplified, [(0, 5), (2, 3), (3, 1), (4, 0), (5, 0), (7, 2), (8, 5)])
+        wsElevs = np.linspace(0.5, 4.5, 9)
+        expected = flowEstimatorBatch(wsElevs, 0.035, 0.002, staElev = CrossSection(staElev), units = 'm')
+        result = flowEstimatorBatch(wsElevs, 0.035, 0.002, staElev = CrossSection(simplified), units = 'm')
+        np.testing.assert_allclose(result, expected)
+
+    def test_simplify_tolerance(self):
+        """Test Douglas-Peucker keeps the ends and thalweg and stays within the tolerance."""
+        station = np.linspace(0, 20, 401)
+        elevation = abs(station - 10.3) + 0.02*np.sin(7*station)
+        simplified = simplifySection(np.column_stack((station, elevation)), 0.05)
+        self.assertLess(len(simplified), 50)
+        self.assertIn(elevation.min(), simplified[:,1])
+        self.assertEqual(simplified[0,0], 0)
+        self.assertEqual(simplified[-1,0], 20)
+        self.assertTrue(np.all(abs(np.interp(station, simplified[:,0], simplified[:,1]) - elevation) <= 0.05*2**0.5))
+
+    def test_conveyance_table(self):
+        """Test the conveyance table is shared by the section and agrees with the batch solver between breakpoints."""
+        section = CrossSection([(0, 5), (2, 3), (4, 0), (6, 1.5), (7, 2), (8, 1), (9, 3), (11, 6)])
+        table = section.conveyanceTable()
+        self.assertIsInstance(table, ConveyanceTable)
+        self.assertIs(section.conveyanceTable(), table)
+        wsElevs = np.linspace(-0.5, 3.5, 41)
+        expected = flowEstimatorBatch(wsElevs, 0.035, 0.002, staElev = section, units = 'm')
+        np.testing.assert_allclose(table.lookup(wsElevs, 0.035, 0.002, 'm'), expected)
+        args = flowEstimator(1.75, 0.035, 0.002, staElev = section, units = 'm')
+        self.assertAlmostEqual(args[4], table.lookup(1.75, 0.035, 0.002, 'm')[4])
+
+    def test_flat_to_bank(self):
+        """Test a section that is flat out to one bank is rejected, so a conveyance table always has an interval."""
+        staElev = simplifySection([(0, 100), (5, 96), (10, 95), (15, 95), (20, 95)], 0.1)
+        self.assertRaises(ValueError, CrossSection, staElev)
+        self.assertRaises(ValueError, ratingCurve, 0.035, 0.002, staElev = staElev)
+        self.assertRaises(ValueError, normalDepthEstimator, 5., 0.035, 0.002, staElev = staElev)
+        self.assertIsNone(flowEstimator(95.5, 0.035, 0.002, staElev = addDistance(staElev)))
+        # only just deeper than the bank it is flat out to
+        table = CrossSection([(0, 100), (5, 96), (10, 95), (15, 95.001), (20, 95.001)]).conveyanceTable()
+        np.testing.assert_allclose(table.breaks, [95, 95.001])
+        self.assertTrue(table.geometry([95.0005])[0].all())
+
+    def test_adaptive_stages(self):
+        """Test adaptive stages keep interpolation within tolerance and respect the step limits."""
+        section = CrossSection([(0, 105), (20, 101), (30, 100), (45, 102), (60, 106)])
+        discharge = lambda stages: flowEstimatorBatch(stages, 0.035, 0.002, staElev = section, units = 'm')[4]
+        stages, Q = adaptiveStages(discharge, 100.01, 104.99, 0.01, 0.005, 1.0)
+        self.assertEqual(stages[0], 100.01)
+        self.assertEqual(stages[-1], 104.99)
+        self.assertTrue(np.all(np.diff(stages) <= 1.0))
+        self.assertTrue(np.all(np.diff(stages) >= 0.005))
+        np.testing.assert_allclose(Q, discharge(stages))
+        mids = (stages[:-1] + stages[1:])/2.
+        steps = np.diff(stages) >= 0.01
+        error = abs(np.interp(mids, stages, Q) - discharge(mids))/discharge(mids)
+        self.assertTrue(np.all(error[steps] <= 0.01))
+
+    def test_normal_depth(self):
+        """Test the normal depth solver inverts flowEstimator."""
+        section = CrossSection([(0, 105), (20, 101), (30, 100), (45, 102), (60, 106)])
+        for Q in [0.5, 20.0, 150.0]:
+            wsElev = normalDepthEstimator(Q, 0.035, 0.002, staElev = section, units = 'm')
+            args = flowEstimator(wsElev, 0.035, 0.002, staElev = section, units = 'm')
+            self.assertAlmostEqual(args[4], Q, places=3)
+
+    def test_normal_depth_jump(self):
+        """Test a discharge that falls where a dry pocket floods has no normal depth, rather than the stage of the jump."""
+        section = CrossSection([(0, 5), (2, 3), (4, 0), (6, 1.5), (7, 2), (8, 1), (9, 3), (11, 6)])
+        stages, QBelow, QAbove = section.conveyanceTable().jumps(0.035, 0.002, 'm')
+        np.testing.assert_allclose(stages, [2])
+        np.testing.assert_allclose(QBelow, flowEstimator(2, 0.035, 0.002, staElev = section, units = 'm')[4])
+        np.testing.assert_allclose(QAbove, flowEstimator(2.000001, 0.035, 0.002, staElev = section, units = 'm')[4], rtol=1e-5)
+        wsElev = normalDepthEstimator([4.0, 4.124, 4.3], 0.035, 0.002, staElev = section, units = 'm')
+        self.assertTrue(np.isnan(wsElev[1]))
+        np.testing.assert_allclose(flowEstimatorBatch(wsElev[[0, 2]], 0.035, 0.002, staElev = section, units = 'm')[4], [4.0, 4.3], rtol=1e-5)
+
+    def test_normal_depth_trapezoid(self):
+        """Test the normal depth solver for a trapezoidal channel, and for several discharges at once."""
+        depths = normalDepthEstimator([1.0, 10.0, 1000.0], 0.03, 0.001, widthBottom = 3.0, rightSS = 2.0, leftSS = 1.5, units = 'ft')
+        for Q, depth in zip([1.0, 10.0, 1000.0], depths):
+            args = flowEstimator(depth, 0.03, 0.001, widthBottom = 3.0, rightSS = 2.0, leftSS = 1.5, units = 'ft')
+            self.assertAlmostEqual(args[4]/Q, 1.0, places=5)
+
+    def test_normal_depth_too_big(self):
+        """Test a discharge bigger than the channel can carry has no normal depth."""
+        section = CrossSection([(0, 1), (1, 0), (2, 1)])
+        self.assertTrue(np.isnan(normalDepthEstimator(1e6, 0.035, 0.002, staElev = section, units = 'm')))
+
+    def test_reach_table(self):
+        """Test every section along a reach is solved for the discharge, and sections off the DEM are skipped."""
+        stations = np.array([0, 20, 30, 45, 60])
+        ground = np.array([105, 101, 100, 102, 106])
+        elevations = np.array([ground, ground - 1, ground*np.nan])
+        centerDist, wsElev, R, P, area, topWidth, Q, v, depth = reachTable([0, 50, 100], stations, elevations, 20.0, 0.035, 0.002, units = 'm')
+        np.testing.assert_allclose(Q[:2], 20.0)
+        self.assertAlmostEqual(wsElev[0] - wsElev[1], 1.0)
+        self.assertAlmostEqual(wsElev[0], normalDepthEstimator(20.0, 0.035, 0.002, staElev = np.column_stack((stations, ground)), units = 'm'))
+        self.assertTrue(np.isnan(wsElev[2]))
+        # a section where the discharge falls inside the jump as a dry pocket floods is skipped, not reported at the breakpoint
+        stations = np.array([0, 2, 4, 6, 7, 8, 9, 11])
+        ground = np.array([5, 3, 0, 1.5, 2, 1, 3, 6])
+        centerDist, wsElev, R, P, area, topWidth, Q, v, depth = reachTable([0, 50], stations, np.array([ground, ground + 1]), 4.124, 0.035, 0.002, units = 'm')
+        self.assertTrue(np.isnan(wsElev).all())
+        self.assertTrue(np.isnan(Q).all())
+        centerDist, wsElev, R, P, area, topWidth, Q, v, depth = reachTable([0, 50], stations, np.array([ground, ground + 1]), 4.3, 0.035, 0.002, units = 'm')
+        np.testing.assert_allclose(Q, 4.3, rtol=1e-5)
+
+
+if __name__ == "__main__":
+    suite = unittest.makeSuite(OpenChannelTest)
+    runner = unittest.TextTestRunner(verbosity=2)
+    runner.run(suite)